@@ -0,0 +1,59 @@
+# IMPORTS
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from keys import load_private_key, unwrap_data_key, is_rsa_ciphertext, unseal
+
+
+# decrypt a batch of draws owned by one user, unwrapping the user's data key once
+# (runs inside pool worker processes so must not touch the app or database)
+def decrypt_owner_draws(draw_key, private_key, ciphertexts):
+    private_key = load_private_key(private_key)
+    cipher = AESGCM(unwrap_data_key(draw_key, private_key)) if draw_key is not None else None
+    # draws encrypted before data keys are decrypted with the private key itself
+    return [(rsa.decrypt(ciphertext, private_key) if is_rsa_ciphertext(ciphertext, private_key)
+             else unseal(cipher, ciphertext)).decode('utf-8')
+            for ciphertext in ciphertexts]
+
+
+# create a process pool for settlement, or None to decrypt in the request process
+# (workers are spawned rather than forked: a fork would copy the worker's threads' locks, open database connections
+# and cached private keys into every child)
+def create_pool(workers):
+    if workers > 1:
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    return None
+
+
+# decrypt draws (rows of id, user_id, numbers) with their owners' draw keys, returns {draw id: numbers}
+def decrypt_draws(draws, owners, pool=None, chunk_size=250):
+    # group ciphertexts by owner so each task only needs one data key
+    grouped = defaultdict(list)
+    for draw in draws:
+        grouped[draw.user_id].append(draw)
+
+    # split each owner's draws into tasks of at most chunk_size ciphertexts
+    tasks = []
+    for user_id, owner_draws in grouped.items():
+        for i in range(0, len(owner_draws), chunk_size):
+            tasks.append((owners[user_id].draw_key, owners[user_id].private_draw_key,
+                          owner_draws[i:i + chunk_size]))
+
+    if pool is None:
+        batches = [decrypt_owner_draws(draw_key, private_key, [draw.numbers for draw in batch])
+                   for draw_key, private_key, batch in tasks]
+    else:
+        futures = [pool.submit(decrypt_owner_draws, draw_key, private_key, [draw.numbers for draw in batch])
+                   for draw_key, private_key, batch in tasks]
+        batches = [future.result() for future in futures]
+
+    decrypted = {}
+    for (_, _, batch), numbers in zip(tasks, batches):
+        for draw, plaintext in zip(batch, numbers):
+            decrypted[draw.id] = plaintext
+
+    return decrypted
@@ -0,0 +1,126 @@
+# IMPORTS
+import gzip
+import os
+from collections import deque
+
+from security_log import archive_path, index_path
+
+# bytes read from the end of a log file at a time
+BLOCK_SIZE = 8192
+
+
+# current log file followed by its compressed archives, newest first
+def log_files(filename):
+    files = [filename] if os.path.exists(filename) else []
+    number = 1
+    while os.path.exists(archive_path(filename, number)):
+        files.append(archive_path(filename, number))
+        number += 1
+    return files
+
+
+# yield (offset, line) for the lines of an open binary file starting before end, last line first
+def read_backwards(f, end):
+    position = end
+    remainder = b''
+    while position > 0:
+        size = min(BLOCK_SIZE, position)
+        position -= size
+        f.seek(position)
+        lines = (f.read(size) + remainder).split(b'\n')
+        # the first line may carry on into the previous block
+        remainder = lines.pop(0)
+        offset = position + len(remainder) + 1
+        found = []
+        for line in lines:
+            found.append((offset, line))
+            offset += len(line) + 1
+        for offset, line in reversed(found):
+            if line:
+                yield offset, line
+    if remainder:
+        yield 0, remainder
+
+
+# yield offsets of the index entries matching the filters that start before end, newest first
+def matching_offsets(path, end, event, user_id, ip):
+    if not os.path.exists(index_path(path)):
+        return
+    with open(index_path(path), 'rb') as index:
+        for _, entry in read_backwards(index, os.path.getsize(index_path(path))):
+            offset, entry_event, entry_user_id, entry_ip = entry.decode().split('\t')
+            offset = int(offset)
+            if end is not None and offset >= end:
+                continue
+            if (event is None or entry_event == event) and (user_id is None or entry_user_id == user_id) \
+                    and (ip is None or entry_ip == ip):
+                yield offset
+
+
+# yield (offset, line) of the entries in the live log matching the filters, newest first
+def read_log(path, end, event=None, user_id=None, ip=None):
+    with open(path, 'rb') as log:
+        if event is None and user_id is None and ip is None:
+            yield from read_backwards(log, os.path.getsize(path) if end is None else end)
+            return
+
+        # filtered reads only touch the index and the matching lines of the log
+        for offset in matching_offsets(path, end, event, user_id, ip):
+            log.seek(offset)
+            yield offset, log.readline().rstrip(b'\n')
+
+
+# return up to limit (offset, line) entries of a compressed archive matching the filters, newest first
+def read_archive(path, end, limit, event=None, user_id=None, ip=None):
+    wanted = None
+    if event is not None or user_id is not None or ip is not None:
+        wanted = set()
+        for offset in matching_offsets(path, end, event, user_id, ip):
+            wanted.add(offset)
+            if len(wanted) == limit:
+                break
+        if not wanted:
+            return []
+        last = max(wanted)
+
+    # gzip streams can't be read backwards, so decompress forwards keeping only the newest entries
+    found = deque(maxlen=limit)
+    offset = 0
+    with gzip.open(path, 'rb') as archive:
+        for line in archive:
+            if (end is not None and offset >= end) or (wanted is not None and offset > last):
+                break
+            if wanted is None or offset in wanted:
+                found.append((offset, line.rstrip(b'\n')))
+            offset += len(line)
+    return reversed(found)
+
+
+def tail(filename, count, before=None, event=None, user_id=None, ip=None):
+    """Return up to count log entries (newest first) older than the before cursor, and the cursor of the next page
+
+    A cursor is 'file number:offset', numbering the live log and its archives from 0 (newest first).
+    """
+    try:
+        file_number, end = (int(part) for part in before.split(':'))
+    except (AttributeError, ValueError):  # no cursor (or a malformed one) starts from the newest entry
+        file_number, end = 0, None
+
+    entries = []
+    files = log_files(filename)
+    for number in range(file_number, len(files)):
+        path = files[number]
+        if number != file_number:
+            end = None
+
+        if path.endswith('.gz'):
+            found = read_archive(path, end, count - len(entries), event, user_id, ip)
+        else:
+            found = read_log(path, end, event, user_id, ip)
+
+        for offset, line in found:
+            entries.append(line.decode('utf-8', 'replace'))
+            if len(entries) == count:
+                return entries, '%d:%d' % (number, offset)
+
+    return entries, None
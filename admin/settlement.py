@@ -0,0 +1,146 @@
+# IMPORTS
+import logging
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import update, delete, func
+
+from admin.decryption import create_pool, decrypt_draws
+from app import db
+from jobs import job_handler, LeaseLost
+from lottery.numbers import PRIZE_TIERS, DRAW_SIZE, numbers_to_mask, masks_from_strings, match_counts
+from models import User, Draw, Round, RoundResult, decrypt, unplayed_draws, draws_after
+
+
+# load the owners of a chunk of draws that have not already been loaded (single IN query)
+def load_owners(draws, owners):
+    missing_ids = {draw.user_id for draw in draws} - owners.keys()
+
+    if missing_ids:
+        # only the columns needed for settlement, so rows survive commits between chunks
+        for owner in db.session.query(User.id, User.email, User.draw_key, User.private_draw_key) \
+                .filter(User.id.in_(missing_ids)).all():
+            owners[owner.id] = owner
+
+    return owners
+
+
+# settle all unplayed user draws against the round's winning numbers, storing winners by prize tier
+# Each chunk is committed together with the round's high-water mark, so an interrupted settlement continues after the
+# last committed chunk without decrypting its draws again. The round is only marked settled once every chunk is done.
+# progress(processed, total, checkpoint) is called after each chunk is committed.
+def settle_draws(current_round, winning_numbers, chunk_size, workers=1, decrypt_chunk_size=250, progress=None):
+    winning_mask = numbers_to_mask(winning_numbers.split())
+    lottery_round = current_round.id
+    owners = {}
+
+    # carry on from the last committed chunk of an earlier run
+    last_id = current_round.settled_through
+    settled = current_round.entries
+    started = time.perf_counter() - (current_round.settlement_seconds or 0.0)
+
+    # draws left to settle, for progress reporting (draws entered meanwhile are settled too)
+    total = settled + db.session.query(func.count(Draw.id)).filter_by(been_played=False) \
+        .filter(Draw.id > last_id).scalar()
+
+    # fan decryption out over worker processes
+    pool = create_pool(workers)
+
+    try:
+        while True:
+            # get next chunk of unplayed user draws (keyset pagination on primary key)
+            draws = draws_after(unplayed_draws(), last_id, chunk_size).all()
+
+            if not draws:
+                break
+
+            load_owners(draws, owners)
+
+            # decrypt draw numbers, grouped by owner
+            decrypted = decrypt_draws(draws, owners, pool, decrypt_chunk_size)
+            numbers = [decrypted[draw.id] for draw in draws]
+
+            # count matches for the whole chunk at once (popcount of each draw's mask AND the winning mask)
+            counts = match_counts(masks_from_strings(numbers), winning_mask)
+
+            # played draws are stored decrypted (see check_draws)
+            updates = [{'id': draw.id,
+                        'numbers': draw_numbers,
+                        'been_played': True,
+                        'matches_master': count == DRAW_SIZE,
+                        'match_count': count,
+                        'lottery_round': lottery_round}
+                       for draw, draw_numbers, count in zip(draws, numbers, counts.tolist())]
+
+            settled += len(draws)
+            previous_id, last_id = last_id, draws[-1].id
+
+            # move the high-water mark on from where this settlement found it, and write the chunk back with a single
+            # bulk UPDATE in the same transaction (if another worker has moved the mark, it has taken over)
+            moved = db.session.execute(update(Round)
+                                       .where(Round.id == lottery_round, Round.settled_through == previous_id)
+                                       .values(settled_through=last_id, entries=settled,
+                                               settlement_seconds=time.perf_counter() - started)).rowcount
+            if not moved:
+                db.session.rollback()
+                raise LeaseLost('Round %s is being settled by another worker' % lottery_round)
+            db.session.execute(update(Draw), updates)
+            db.session.commit()
+
+            if progress is not None:
+                progress(settled, max(total, settled), {'settled_through': last_id})
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    elapsed = time.perf_counter() - started
+
+    # winners are read back from the settled draws, so a resumed settlement includes those of earlier runs
+    winners = {tier: [] for tier in PRIZE_TIERS}
+    for draw in db.session.query(Draw.match_count, Draw.numbers, Draw.user_id, User.email) \
+            .join(User, User.id == Draw.user_id) \
+            .filter(Draw.lottery_round == lottery_round, Draw.match_count.in_(PRIZE_TIERS)) \
+            .order_by(Draw.id):
+        winners[draw.match_count].append([draw.numbers, draw.user_id, draw.email])
+
+    # store per-tier results and round statistics, and mark the round settled, in one final transaction
+    # no make_transient() required as can store numbers as string in the database once settled
+    marked = db.session.execute(update(Round)
+                                .where(Round.id == lottery_round, Round.settled == False,  # noqa: E712
+                                       Round.settled_through == last_id)
+                                .values(numbers=winning_numbers, settled=True, settled_on=datetime.now(),
+                                        entries=settled, winners=sum(len(results) for results in winners.values()),
+                                        settlement_seconds=elapsed)).rowcount
+    if not marked:
+        db.session.rollback()
+        raise LeaseLost('Round %s was settled by another worker' % lottery_round)
+    db.session.execute(delete(RoundResult).where(RoundResult.lottery_round == lottery_round))
+    for tier, results in winners.items():
+        db.session.add(RoundResult(lottery_round, tier, results))
+    db.session.commit()
+
+    stats = {'draws': settled,
+             'seconds': elapsed,
+             'draws_per_second': settled / elapsed if elapsed > 0 else 0.0}
+
+    logging.info('Lottery round %s settled: %s draws in %.3fs (%.1f draws/sec)', lottery_round, settled,
+                 elapsed, stats['draws_per_second'])
+
+    return stats
+
+
+# settle a round in a background job, a rerun (or a worker taking over the job) resumes from the round's high-water mark
+@job_handler('settle_round')
+def settle_round_job(job, report):
+    current_round = db.session.get(Round, job['payload']['round'])
+    if current_round.settled:
+        return None
+
+    # decrypt winning numbers (numbers are encrypted with the key of the admin who generated them)
+    admin = db.session.get(User, current_round.user_id)
+    winning_numbers = decrypt(current_round.numbers, admin.draw_key, admin.private_draw_key, current_round.user_id)
+
+    return settle_draws(current_round, winning_numbers, current_app.config['SETTLEMENT_CHUNK_SIZE'],
+                        current_app.config['SETTLEMENT_WORKERS'], current_app.config['SETTLEMENT_DECRYPT_CHUNK_SIZE'],
+                        report)
@@ -1,19 +1,69 @@
 # IMPORTS
-import logging
 import secrets
+from datetime import datetime, timedelta
 
-from flask import Blueprint, render_template, flash, redirect, url_for, request
+import click
+from flask import Blueprint, render_template, flash, redirect, url_for, request, current_app, jsonify
 from flask_login import login_required, current_user
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import make_transient
 
-from app import db
+from app import db, app
 from app import requires_roles
-from models import User, Draw, encrypt
+from admin.logs import tail
+from admin import settlement  # noqa: F401 (registers the settle_round job handler)
+from audit import audit_handler, count_events, events_per_ip, events_per_user, events_per_hour
+from jobs import job_queue, job_progress
+from models import User, Draw, Round, RoundResult, encrypt, key_cache, keypair_pool, password_hasher, archive_draws, \
+    activity_totals, rebuild_activity_summary
+from pages import template_cache
+from security_log import SECURITY_EVENTS, security_log, security_logger
 from users.forms import RegisterForm
 
 # CONFIG
 admin_blueprint = Blueprint('admin', __name__, template_folder='templates')
 
+# columns the user listings can be sorted by, each backed by an index on (role, column)
+USER_SORTS = {'id': User.id, 'current_login': User.current_login, 'total_logins': User.total_logins}
+
+
+# sort column and direction of the user listings given in the request, as (name, descending)
+def user_sort():
+    sort = request.args.get('sort')
+    return (sort if sort in USER_SORTS else 'id'), request.args.get('order') == 'desc'
+
+
+# rows sorting after the row (value, id) in a listing ordered by (column, id), NULLs sort first as in SQLite
+def after_row(column, value, id, descending):
+    if value is None:
+        if descending:
+            return and_(column.is_(None), User.id < id)
+        return or_(column.isnot(None), and_(column.is_(None), User.id > id))
+    if descending:
+        return or_(column < value, and_(column == value, User.id < id), column.is_(None))
+    return or_(column > value, and_(column == value, User.id > id))
+
+
+# next page of users after the user id given in the request (keyset pagination), returns (users, next after id)
+def users_page(query):
+    sort, descending = user_sort()
+    column = USER_SORTS[sort]
+    per_page = current_app.config['USERS_PAGE_SIZE']
+
+    after = request.args.get('after', type=int)
+    if after is not None:
+        # the page continues from the sort value of the last user shown
+        value = db.session.query(column).filter(User.id == after).scalar()
+        query = query.filter(after_row(column, value, after, descending))
+
+    order = (column.desc(), User.id.desc()) if descending else (column, User.id)
+    # fetch one extra user to find out whether there is another page
+    users = query.order_by(*order).limit(per_page + 1).all()
+
+    if len(users) > per_page:
+        return users[:per_page], users[per_page - 1].id
+    return users, None
+
 
 # VIEWS
 # view admin homepage
@@ -21,7 +71,7 @@ admin_blueprint = Blueprint('admin', __name__, template_folder='templates')
 @login_required
 @requires_roles('admin')
 def admin():
-    return render_template('admin/admin.html', name=current_user.firstname)
+    return render_template('admin/admin.html', name=current_user.firstname, totals=activity_totals(datetime.now()))
 
 
 # create a new winning draw
@@ -29,18 +79,14 @@ def admin():
 @login_required
 @requires_roles('admin')
 def generate_winning_draw():
-    # get current winning draw
-    current_winning_draw = Draw.query.filter_by(master_draw=True).first()
-    lottery_round = 1
-
-    # if a current winning draw exists
-    if current_winning_draw:
-        # update lottery round by 1
-        lottery_round = current_winning_draw.lottery_round + 1
+    # the winning numbers can't change under a settlement in progress, or one that was interrupted
+    if job_queue.active('settle_round') or \
+            db.session.query(Round.id).filter_by(settled=False).filter(Round.settled_through > 0).first():
+        flash("A lottery round is being settled. Try again once it has finished.")
+        return redirect(url_for('admin.admin'))
 
-        # delete current winning draw
-        db.session.delete(current_winning_draw)
-        db.session.commit()
+    # get current unsettled round (if any)
+    current_round = Round.query.filter_by(settled=False).first()
 
     # get new winning numbers for draw (pseudo-random)
     # winning_numbers = random.sample(range(1, 60), 6)
@@ -59,19 +105,20 @@ def generate_winning_draw():
     winning_numbers_string = winning_numbers_string[:-1]
 
     # encrypt winning numbers with admin's draw key
+    winning_numbers_encrypted = encrypt(winning_numbers_string, current_user.draw_key, current_user.private_draw_key,
+                                        current_user.id)
 
-    # Symmetric
-    # winning_numbers_encrypted = encrypt(winning_numbers_string, current_user.draw_key)
-
-    # Asymmetric
-    winning_numbers_encrypted = encrypt(winning_numbers_string, current_user.public_draw_key)
+    # if the current round has not been settled, replace its winning numbers
+    if current_round:
+        current_round.user_id = current_user.id
+        current_round.numbers = winning_numbers_encrypted
+        current_round.created_on = datetime.now()
 
-    # create a new draw object.
-    new_winning_draw = Draw(user_id=current_user.id, numbers=winning_numbers_encrypted, master_draw=True,
-                            lottery_round=lottery_round)
+    # otherwise start a new round (previous rounds are kept as history)
+    else:
+        current_round = Round(user_id=current_user.id, numbers=winning_numbers_encrypted)
+        db.session.add(current_round)
 
-    # add the new winning draw to the database
-    db.session.add(new_winning_draw)
     db.session.commit()
 
     # re-render admin page
@@ -84,22 +131,20 @@ def generate_winning_draw():
 @login_required
 @requires_roles('admin')
 def view_winning_draw():
-    # get winning draw from DB
-    current_winning_draw = Draw.query.filter_by(master_draw=True, been_played=False).first()
+    # get winning draw of current unsettled round from DB
+    current_round = Round.query.filter_by(settled=False).first()
 
     # if a winning draw exists
-    if current_winning_draw:
+    if current_round:
         # decrypt winning numbers
-        make_transient(current_winning_draw)
+        make_transient(current_round)
 
-        # Symmetric
-        # current_winning_draw.view_draw(current_user.draw_key)
-
-        # Asymmetric
-        current_winning_draw.view_draw(current_user.private_draw_key)
+        # numbers are encrypted with the key of the admin who generated them
+        admin = db.session.get(User, current_round.user_id)
+        current_round.view_numbers(admin.draw_key, admin.private_draw_key)
 
         # re-render admin page with current winning draw and lottery round
-        return render_template('admin/admin.html', winning_draw=current_winning_draw, name=current_user.firstname)
+        return render_template('admin/admin.html', winning_draw=current_round, name=current_user.firstname)
 
     # if no winning draw exists, rerender admin page
     flash("No valid winning draw exists. Please add new winning draw.")
@@ -111,78 +156,82 @@ def view_winning_draw():
 @login_required
 @requires_roles('admin')
 def run_lottery():
-    # get current unplayed winning draw
-    current_winning_draw = Draw.query.filter_by(master_draw=True, been_played=False).first()
-
-    # if current unplayed winning draw exists
-    if current_winning_draw:
-
-        # get all unplayed user draws
-        user_draws = Draw.query.filter_by(master_draw=False, been_played=False).all()
-        results = []
+    # get current unsettled round
+    current_round = Round.query.filter_by(settled=False).first()
 
-        # if at least one unplayed user draw exists
-        if user_draws:
+    # if current unsettled round exists
+    if current_round:
 
-            # update current winning draw as played
-            current_winning_draw.been_played = True
-            db.session.add(current_winning_draw)
-            db.session.commit()
+        # check at least one unplayed user draw exists (draws are loaded in chunks during settlement)
+        user_draw = Draw.query.filter_by(been_played=False).first()
 
-            # decrypt winning numbers
-            # no make_transient() required as can store draw as string in the database
+        # if at least one unplayed user draw exists, or an interrupted settlement of this round can be resumed
+        if user_draw or current_round.settled_through:
 
-            # Symmetric
-            # current_winning_draw.view_draw(current_user.draw_key)
+            # the round is marked settled (and its numbers stored decrypted) by the job once every draw is settled
+            # settle user draws in a background job (one settlement at a time, as rounds share the unplayed draws)
+            job_id, _ = job_queue.enqueue('settle_round', 'settle_round', {'round': current_round.id})
 
-            # Asymmetric
-            current_winning_draw.view_draw(current_user.private_draw_key)
+            # the admin page polls the job's progress and shows the results once it is done
+            flash("Settlement of round %s queued." % current_round.id)
+            return render_template('admin/admin.html', settlement_job=job_id, name=current_user.firstname)
 
-            # for each unplayed user draw
-            for draw in user_draws:
-
-                # get the owning user (instance/object)
-                user = User.query.filter_by(id=draw.user_id).first()
+        flash("No user draws entered.")
+        return redirect(url_for('admin.admin'))
 
-                # decrypt draw numbers
-                # no make_transient() required as can store draw as string in the database
+    # if current unsettled round does not exist
+    flash("Current winning draw expired. Add new winning draw for next round.")
+    return redirect(url_for('admin.admin'))
 
-                # Symmetric
-                # draw.view_draw(user.draw_key)
 
-                # Asymmetric
-                draw.view_draw(user.private_draw_key)
+# progress of a settlement job, polled by the admin page
+@admin_blueprint.route('/settlement_progress/<int:job_id>')
+@login_required
+@requires_roles('admin')
+def settlement_progress(job_id):
+    job = job_queue.get(job_id)
+    if job is None or job['kind'] != 'settle_round':
+        return jsonify(error='No such settlement'), 404
+    return jsonify(job_progress(job))
 
-                # if user draw matches current unplayed winning draw
-                if draw.numbers == current_winning_draw.numbers:
-                    # add details of winner to list of results
-                    results.append((current_winning_draw.lottery_round, draw.numbers, draw.user_id, user.email))
 
-                    # update draw as a winning draw (this will be used to highlight winning draws in the user's
-                    # lottery page)
-                    draw.matches_master = True
+# view stored results of the most recently settled round
+@admin_blueprint.route('/lottery_results')
+@login_required
+@requires_roles('admin')
+def lottery_results():
+    lottery_round = db.session.query(db.func.max(RoundResult.lottery_round)).scalar()
 
-                # update draw as played
-                draw.been_played = True
+    if lottery_round is None:
+        flash("No lottery rounds have been played.")
+        return redirect(url_for('admin.admin'))
 
-                # update draw with current lottery round
-                draw.lottery_round = current_winning_draw.lottery_round
+    # statistics stored with the round when it was settled
+    current_round = db.session.get(Round, lottery_round)
+    seconds = current_round.settlement_seconds or 0.0
+    settlement = {'draws': current_round.entries,
+                  'seconds': seconds,
+                  'draws_per_second': current_round.entries / seconds if seconds > 0 else 0.0}
 
-                # commit draw changes to DB
-                db.session.add(draw)
-                db.session.commit()
+    return render_template('admin/admin.html', winners=RoundResult.winners_by_tier(lottery_round),
+                           settlement=settlement, name=current_user.firstname)
 
-            # if no winners
-            if len(results) == 0:
-                flash("No winners.")
 
-            return render_template('admin/admin.html', results=results, name=current_user.firstname)
+# move played draws of old rounds into the draws archive
+@admin_blueprint.route('/archive_rounds')
+@login_required
+@requires_roles('admin')
+def archive_rounds():
+    latest_round = db.session.query(db.func.max(Round.id)).filter_by(settled=True).scalar()
 
-        flash("No user draws entered.")
+    if latest_round is None:
+        flash("No lottery rounds have been played.")
         return redirect(url_for('admin.admin'))
 
-    # if current unplayed winning draw does not exist
-    flash("Current winning draw expired. Add new winning draw for next round.")
+    # keep the most recent rounds live so users can still check their results
+    archived = archive_draws(Draw.lottery_round <= latest_round - current_app.config['ARCHIVE_KEEP_ROUNDS'])
+
+    flash("%s played draws archived." % archived)
     return redirect(url_for('admin.admin'))
 
 
@@ -191,30 +240,64 @@ def run_lottery():
 @login_required
 @requires_roles('admin')
 def view_all_users():
-    current_users = User.query.filter_by(role='user').all()
+    current_users, users_after = users_page(db.session.query(User.id, User.email, User.firstname, User.lastname,
+                                                             User.date_of_birth, User.postcode, User.phone,
+                                                             User.role).filter_by(role='user'))
 
-    return render_template('admin/admin.html', name=current_user.firstname, current_users=current_users)
+    return render_template('admin/admin.html', name=current_user.firstname, current_users=current_users,
+                           users_after=users_after, user_sort=user_sort())
 
 
 @admin_blueprint.route('/view_user_activity')
 @login_required
 @requires_roles('admin')
 def view_user_activity():
-    current_user_activity = User.query.filter_by(role='user').all()
+    current_user_activity, activity_after = users_page(
+        db.session.query(User.id, User.email, User.registered_on, User.current_login, User.current_login_ip,
+                         User.last_login, User.last_login_ip, User.total_logins).filter_by(role='user'))
 
-    return render_template('admin/admin.html', name=current_user.firstname, current_user_activity=current_user_activity)
+    return render_template('admin/admin.html', name=current_user.firstname, current_user_activity=current_user_activity,
+                           activity_after=activity_after, user_sort=user_sort())
 
 
-# view last 10 log entries
+# view security log entries, newest first, optionally filtered by event, user id or IP address
 @admin_blueprint.route('/logs')
 @login_required
 @requires_roles('admin')
 def logs():
-    with open("lottery.log", "r") as f:
-        content = f.read().splitlines()[-10:]
-        content.reverse()
+    filters = {name: request.args.get(name) or None for name in ('event', 'user_id', 'ip')}
+    content, logs_before = tail(current_app.config['SECURITY_LOG_FILE'], current_app.config['LOG_PAGE_SIZE'],
+                                request.args.get('before'), **filters)
 
-    return render_template('admin/admin.html', logs=content, name=current_user.firstname)
+    return render_template('admin/admin.html', logs=content, logs_before=logs_before, log_filters=filters,
+                           log_events=SECURITY_EVENTS, name=current_user.firstname)
+
+
+# internal counters for monitoring
+@admin_blueprint.route('/metrics')
+@login_required
+@requires_roles('admin')
+def metrics():
+    return jsonify(key_cache=key_cache.stats(), keypair_pool=keypair_pool.stats(),
+                   password_hasher=password_hasher.stats(), security_log=security_log.stats(),
+                   audit=audit_handler.stats(), template_cache=template_cache.stats())
+
+
+# security event counts from the audit table, e.g. /security_events?event=login_failed&hours=24&ip=1.2.3.4
+@admin_blueprint.route('/security_events')
+@login_required
+@requires_roles('admin')
+def security_events():
+    event = request.args.get('event', 'login_failed')
+    since = datetime.now() - timedelta(hours=request.args.get('hours', 24, type=int))
+    ip = request.args.get('ip')
+    user_id = request.args.get('user_id', type=int)
+
+    return jsonify(event=event, since=since.isoformat(),
+                   count=count_events(since, event, ip, user_id),
+                   per_ip=[list(row) for row in events_per_ip(event, since)],
+                   per_user=[list(row) for row in events_per_user(event, since)],
+                   per_hour=[list(row) for row in events_per_hour(event, since)])
 
 
 @admin_blueprint.route('/register_new_admin', methods=['GET', 'POST'])
@@ -226,7 +309,7 @@ def register_new_admin():
     validation_message = ''
 
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        user = db.session.query(User.id).filter_by(email=form.email.data).first()
         # if this returns a user, email already exists in database
 
         # if email already exists redirect user back to signup page with error message so user can try again
@@ -250,8 +333,18 @@ def register_new_admin():
 
         flash('New admin registered successfully.')
 
-        logging.warning('SECURITY - New admin registered [%s, %s]', form.email.data, request.remote_addr)
+        security_logger.warning('SECURITY - New admin registered [%s, %s]', form.email.data, request.remote_addr,
+                                extra={'event': 'register_admin', 'user_id': new_user.id, 'email': form.email.data,
+                                       'ip': request.remote_addr})
 
         return redirect(url_for('admin.admin'))
 
     return render_template('users/register.html', form=form, validation_message=validation_message)
+
+
+# recount the dashboard totals from the users table: flask rebuild-activity-summary
+@app.cli.command('rebuild-activity-summary')
+def rebuild_activity_summary_command():
+    rebuild_activity_summary()
+    click.echo('Registered users: %(registered_users)d, active today: %(active_today)d, '
+               'logins in the last 24 hours: %(logins_24h)d' % activity_totals(datetime.now()))
@@ -1,15 +1,17 @@
 # IMPORTS
-import logging
 import os
 from functools import wraps
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, request
+from flask import Flask, request
 from flask_login import LoginManager, current_user
 from flask_qrcode import QRcode
 from flask_sqlalchemy import SQLAlchemy
 from flask_talisman import Talisman
 
+from database import engine_options, configure_engine
+from security_log import security_log, security_logger
+
 csp = {  # Content Security Policy
     'default-src': [  # Whitelist content sources
         '\'self\'',
@@ -37,19 +39,6 @@ csp = {  # Content Security Policy
 }
 
 
-class SecurityFilter(logging.Filter):
-    def filter(self, record):
-        return 'SECURITY' in record.getMessage()
-
-
-logger = logging.getLogger()
-file_handler = logging.FileHandler('lottery.log', 'a')
-file_handler.setLevel(logging.WARNING)
-file_handler.addFilter(SecurityFilter())
-formatter = logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-
 # CONFIG
 load_dotenv()
 app = Flask(__name__)
@@ -57,11 +46,60 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
 app.config['SQLALCHEMY_ECHO'] = os.getenv('SQLALCHEMY_ECHO') == 'True'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS') == 'True'
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 20))
+app.config['DB_POOL_TIMEOUT'] = int(os.getenv('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', 1800))
+app.config['SQLITE_JOURNAL_MODE'] = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config)
+app.config['CHECK_QUERY_PLANS'] = os.getenv('CHECK_QUERY_PLANS') == 'True'
 app.config['RECAPTCHA_PUBLIC_KEY'] = os.getenv('RECAPTCHA_PUBLIC_KEY')
 app.config['RECAPTCHA_PRIVATE_KEY'] = os.getenv('RECAPTCHA_PRIVATE_KEY')
+app.config['TEMPLATE_CACHE_SIZE'] = int(os.getenv('TEMPLATE_CACHE_SIZE', 256))
+app.config['USER_CACHE_BACKEND'] = os.getenv('USER_CACHE_BACKEND')
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 300))
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 10000))
+app.config['RATELIMIT_BACKEND'] = os.getenv('RATELIMIT_BACKEND', 'memory')
+app.config['RATELIMIT_SQLITE_PATH'] = os.getenv('RATELIMIT_SQLITE_PATH',
+                                                os.path.join(app.instance_path, 'ratelimit.db'))
+app.config['LOGIN_ATTEMPTS_PER_IP'] = int(os.getenv('LOGIN_ATTEMPTS_PER_IP', 20))
+app.config['LOGIN_ATTEMPTS_PER_EMAIL'] = int(os.getenv('LOGIN_ATTEMPTS_PER_EMAIL', 3))
+app.config['LOGIN_ATTEMPTS_PERIOD'] = int(os.getenv('LOGIN_ATTEMPTS_PERIOD', 300))
+app.config['REGISTRATIONS_PER_IP'] = int(os.getenv('REGISTRATIONS_PER_IP', 5))
+app.config['REGISTRATIONS_PERIOD'] = int(os.getenv('REGISTRATIONS_PERIOD', 3600))
+app.config['BCRYPT_ROUNDS'] = int(os.getenv('BCRYPT_ROUNDS', 12))
+app.config['HASH_WORKERS'] = int(os.getenv('HASH_WORKERS', os.cpu_count() or 1))
+app.config['HASH_QUEUE_SIZE'] = int(os.getenv('HASH_QUEUE_SIZE', 16))
+app.config['KEY_CACHE_SIZE'] = int(os.getenv('KEY_CACHE_SIZE', 1024))
+app.config['KEYPAIR_POOL_SIZE'] = int(os.getenv('KEYPAIR_POOL_SIZE', 8))
+app.config['DRAW_KEY_BITS'] = int(os.getenv('DRAW_KEY_BITS', 512))
+app.config['SETTLEMENT_CHUNK_SIZE'] = int(os.getenv('SETTLEMENT_CHUNK_SIZE', 1000))
+app.config['SETTLEMENT_WORKERS'] = int(os.getenv('SETTLEMENT_WORKERS', os.cpu_count() or 1))
+app.config['SETTLEMENT_DECRYPT_CHUNK_SIZE'] = int(os.getenv('SETTLEMENT_DECRYPT_CHUNK_SIZE', 250))
+app.config['JOBS_DATABASE'] = os.getenv('JOBS_DATABASE', os.path.join(app.instance_path, 'jobs.db'))
+app.config['JOB_LEASE'] = int(os.getenv('JOB_LEASE', 60))
+app.config['JOB_POLL_INTERVAL'] = float(os.getenv('JOB_POLL_INTERVAL', 1))
+app.config['DRAWS_PAGE_SIZE'] = int(os.getenv('DRAWS_PAGE_SIZE', 50))
+app.config['DRAWS_MAX_PAGE_SIZE'] = int(os.getenv('DRAWS_MAX_PAGE_SIZE', 500))
+app.config['BULK_DRAWS_MAX_LINES'] = int(os.getenv('BULK_DRAWS_MAX_LINES', 10000))
+app.config['USERS_PAGE_SIZE'] = int(os.getenv('USERS_PAGE_SIZE', 50))
+app.config['ARCHIVE_KEEP_ROUNDS'] = int(os.getenv('ARCHIVE_KEEP_ROUNDS', 1))
+app.config['REENCRYPT_BATCH_SIZE'] = int(os.getenv('REENCRYPT_BATCH_SIZE', 500))
+app.config['REENCRYPT_ROWS_PER_SECOND'] = float(os.getenv('REENCRYPT_ROWS_PER_SECOND', 2000))
+app.config['SECURITY_LOG_FILE'] = os.getenv('SECURITY_LOG_FILE', 'lottery.log')
+app.config['SECURITY_LOG_QUEUE_SIZE'] = int(os.getenv('SECURITY_LOG_QUEUE_SIZE', 10000))
+app.config['SECURITY_LOG_BATCH_SIZE'] = int(os.getenv('SECURITY_LOG_BATCH_SIZE', 100))
+app.config['SECURITY_LOG_MAX_BYTES'] = int(os.getenv('SECURITY_LOG_MAX_BYTES', 10 * 1024 * 1024))
+app.config['SECURITY_LOG_BACKUP_COUNT'] = int(os.getenv('SECURITY_LOG_BACKUP_COUNT', 30))
+app.config['LOG_PAGE_SIZE'] = int(os.getenv('LOG_PAGE_SIZE', 10))
 
 # initialise database
 db = SQLAlchemy(app)
+with app.app_context():
+    configure_engine(db.engine, app.config)
 talisman = Talisman(app, content_security_policy=csp)
 QRcode(app)
 
@@ -69,7 +107,7 @@ QRcode(app)
 # HOME PAGE VIEW
 @app.route('/')
 def index():
-    return render_template('main/index.html')
+    return render_page('main/index.html')
 
 
 def requires_roles(*roles):  # Create custom wrapper for roles
@@ -77,10 +115,12 @@ def requires_roles(*roles):  # Create custom wrapper for roles
         @wraps(f)
         def wrapped(*args, **kwargs):
             if current_user.role not in roles:
-                logging.warning('SECURITY - User attempted attempted to access page with invalid role[%s, %s, %s, %s]',
-                                current_user.id,
-                                current_user.email, current_user.role, request.remote_addr)
-                return render_template('errors/403.html'), 403
+                security_logger.warning('SECURITY - User attempted attempted to access page with invalid role'
+                                        '[%s, %s, %s, %s]', current_user.id,
+                                        current_user.email, current_user.role, request.remote_addr,
+                                        extra={'event': 'forbidden', 'user_id': current_user.id,
+                                               'email': current_user.email, 'ip': request.remote_addr})
+                return render_page('errors/403.html', 403)
 
             return f(*args, **kwargs)
 
@@ -93,15 +133,20 @@ def anonymous_required(f):
     @wraps(f)
     def wrapped(*args, **kwargs):
         if current_user.is_authenticated:
-            logging.warning('SECURITY - User attempted to access page with invalid role[%s, %s, %s, %s]',
-                            current_user.id,
-                            current_user.email, current_user.role, request.remote_addr)
-            return render_template('errors/403.html'), 403
+            security_logger.warning('SECURITY - User attempted to access page with invalid role[%s, %s, %s, %s]',
+                                    current_user.id,
+                                    current_user.email, current_user.role, request.remote_addr,
+                                    extra={'event': 'forbidden', 'user_id': current_user.id,
+                                           'email': current_user.email, 'ip': request.remote_addr})
+            return render_page('errors/403.html', 403)
         return f(*args, **kwargs)
 
     return wrapped
 
 
+# cached page rendering (also registers the fragment template global)
+from pages import render_page
+
 # BLUEPRINTS
 # import blueprints
 from users.views import users_blueprint
@@ -120,12 +165,31 @@ login_manager = LoginManager()
 login_manager.login_view = 'users.login'
 login_manager.init_app(app)
 
-from models import User
+from models import keypair_pool, check_query_plans
+from upgrade import upgrade_db
+from users.identity import identity_cache
+from audit import audit_handler
+import reencryption  # noqa: F401 (registers the reencrypt-draws command)
+
+# add the tables and columns of this version to a database created by an earlier one
+upgrade_db()
+
+# security events are queued by request threads and written to the log file and audit table in the background
+security_log.start(app.config['SECURITY_LOG_FILE'], app.config['SECURITY_LOG_QUEUE_SIZE'],
+                   app.config['SECURITY_LOG_BATCH_SIZE'], app.config['SECURITY_LOG_MAX_BYTES'],
+                   app.config['SECURITY_LOG_BACKUP_COUNT'], audit_handler)
+
+# start generating draw keypairs before the first registration
+keypair_pool.start()
+
+# refuse to start if hot queries on draws scan or sort the table rather than using indexes
+if app.config['CHECK_QUERY_PLANS']:
+    check_query_plans()
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return identity_cache.load(int(user_id))
 
 
 if __name__ == "__main__":
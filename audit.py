@@ -0,0 +1,95 @@
+# IMPORTS
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import func, insert
+
+from app import db, app
+from database import hour_bucket
+from models import SecurityEvent
+
+
+class AuditHandler(logging.Handler):
+    """Log handler on the security log writer thread that batch inserts security events into the audit table
+
+    Records are buffered and inserted in one statement whenever the writer flushes a batch.
+    """
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.inserted = 0
+        self.failed = 0
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+
+    def emit(self, record):
+        event = getattr(record, 'event', None)
+        if event is None:
+            return
+        with self._buffer_lock:
+            self._buffer.append({'event': event,
+                                 'user_id': getattr(record, 'user_id', None),
+                                 'email': getattr(record, 'email', None),
+                                 'ip': getattr(record, 'ip', None),
+                                 'created_on': datetime.fromtimestamp(record.created)})
+
+    def flush(self):
+        with self._buffer_lock:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return
+
+        try:
+            with app.app_context():
+                db.session.execute(insert(SecurityEvent), rows)
+                db.session.commit()
+            self.inserted += len(rows)
+        except Exception:
+            self.failed += len(rows)
+            logging.getLogger(__name__).exception('Failed to write %d security events', len(rows))
+
+    def stats(self):
+        return {'inserted': self.inserted, 'failed': self.failed, 'buffered': len(self._buffer)}
+
+
+# count events, optionally of one type, from one IP address or for one user, since a time
+def count_events(since, event=None, ip=None, user_id=None):
+    query = db.session.query(func.count(SecurityEvent.id)).filter(SecurityEvent.created_on >= since)
+    if event is not None:
+        query = query.filter(SecurityEvent.event == event)
+    if ip is not None:
+        query = query.filter(SecurityEvent.ip == ip)
+    if user_id is not None:
+        query = query.filter(SecurityEvent.user_id == user_id)
+    return query.scalar()
+
+
+# (IP address, count) of one event type since a time, most frequent first
+def events_per_ip(event, since, limit=20):
+    count = func.count().label('count')
+    return db.session.query(SecurityEvent.ip, count) \
+        .filter(SecurityEvent.event == event, SecurityEvent.created_on >= since) \
+        .group_by(SecurityEvent.ip).order_by(count.desc()).limit(limit).all()
+
+
+# (user id, count) of one event type since a time, most frequent first
+def events_per_user(event, since, limit=20):
+    count = func.count().label('count')
+    return db.session.query(SecurityEvent.user_id, count) \
+        .filter(SecurityEvent.event == event, SecurityEvent.created_on >= since,
+                SecurityEvent.user_id.isnot(None)) \
+        .group_by(SecurityEvent.user_id).order_by(count.desc()).limit(limit).all()
+
+
+# (hour, count) of one event type since a time, in time order, hours formatted as 'YYYY-MM-DD HH:00'
+def events_per_hour(event, since):
+    hour = hour_bucket(db.engine.dialect, SecurityEvent.created_on).label('hour')
+    rows = db.session.query(hour, func.count().label('count')) \
+        .filter(SecurityEvent.event == event, SecurityEvent.created_on >= since) \
+        .group_by(hour).order_by(hour).all()
+    return [(hour if isinstance(hour, str) else hour.strftime('%Y-%m-%d %H:00'), count) for hour, count in rows]
+
+
+# security events are also written to the audit table by the log writer
+audit_handler = AuditHandler()
@@ -0,0 +1,134 @@
+# Measure create_draw throughput and latency while a lottery round is being settled.
+# Run from the project root: python -m benchmarks.database --journal WAL (compare with --journal DELETE)
+import argparse
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--journal', default='WAL')
+parser.add_argument('--users', type=int, default=20)
+parser.add_argument('--draws', type=int, default=5000)
+parser.add_argument('--writers', type=int, default=4)
+args = parser.parse_args()
+
+workdir = tempfile.mkdtemp()
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'benchmark.db')
+os.environ['SQLALCHEMY_ECHO'] = 'False'
+os.environ['SQLITE_JOURNAL_MODE'] = args.journal
+os.environ.setdefault('KEYPAIR_POOL_SIZE', '0')
+os.environ.setdefault('SETTLEMENT_CHUNK_SIZE', '250')
+sys.path.insert(0, os.getcwd())
+os.chdir(workdir)  # keep the benchmark's security log out of the project
+
+import pyotp  # noqa: E402
+from sqlalchemy import insert, text  # noqa: E402
+
+from app import app, db  # noqa: E402
+from jobs import job_queue  # noqa: E402
+from models import User, Draw, encrypt_many, init_db  # noqa: E402
+from lottery.numbers import numbers_to_string  # noqa: E402
+from benchmarks.matching import synthetic_draws  # noqa: E402
+import numpy as np  # noqa: E402
+
+
+def create_users(count, draws):
+    with app.app_context():
+        # one keypair and password hash for all benchmark users, neither is being measured
+        template = User(email='template@email.com', firstname='Bench', lastname='User', date_of_birth='01/01/2000',
+                        postcode='NE1 7RU', phone='1234-123-1234', password='Bench1!', role='user')
+        columns = ('firstname', 'lastname', 'date_of_birth', 'postcode', 'phone', 'password', 'role', 'registered_on',
+                   'total_logins', 'draw_key', 'public_draw_key', 'private_draw_key')
+        values = {column: getattr(template, column) for column in columns}
+        db.session.execute(insert(User), [dict(values, email='user%d@email.com' % i) for i in range(count)])
+        user_ids = [user_id for user_id, in db.session.query(User.id).filter(User.email.like('user%'))]
+
+        encrypted = encrypt_many(synthetic_draws(draws, np.random.default_rng(2031)), template.draw_key,
+                                 template.private_draw_key)
+        db.session.execute(insert(Draw), [{'user_id': user_ids[i % len(user_ids)], 'numbers': numbers,
+                                           'been_played': False, 'matches_master': False, 'match_count': 0}
+                                          for i, numbers in enumerate(encrypted)])
+        db.session.commit()
+        return db.session.query(User.pin_key).filter_by(email='user0@email.com').scalar()
+
+
+def login(client, email, password, pin_key):
+    token = csrf_token(client, '/login')
+    return client.post('/login', base_url='https://localhost',
+                       data={'csrf_token': token, 'email': email, 'password': password, 'postcode': 'NE1 7RU',
+                             'pin': pyotp.TOTP(pin_key).now()})
+
+
+def csrf_token(client, page):
+    html = client.get(page, base_url='https://localhost').data.decode()
+    return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', html).group(1)
+
+
+def writer(number, pin_key, settling, latencies, errors):
+    client = app.test_client()
+    login(client, 'user%d@email.com' % number, 'Bench1!', pin_key)
+    token = csrf_token(client, '/change_password')  # the lottery page only renders its form after a submission
+    numbers = [int(n) for n in numbers_to_string(range(1 + number, 7 + number)).split()]
+    form = dict({'number%d' % (i + 1): n for i, n in enumerate(numbers)}, csrf_token=token)
+
+    while settling.is_set():
+        start = time.perf_counter()
+        try:
+            response = client.post('/create_draw', base_url='https://localhost', data=form)
+            if response.status_code != 302:
+                errors.append(response.status_code)
+                continue
+        except Exception as e:
+            errors.append(type(e).__name__)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def main():
+    app.config['TESTING'] = True  # skips reCAPTCHA verification
+    init_db()
+    pin_key = create_users(args.users, args.draws)
+
+    with app.app_context():
+        journal = db.session.execute(text('PRAGMA journal_mode')).scalar()
+        admin_pin_key = User.query.filter_by(role='admin').first().pin_key
+
+    admin = app.test_client()
+    login(admin, 'admin@email.com', 'Admin1!', admin_pin_key)
+    admin.get('/generate_winning_draw', base_url='https://localhost')
+
+    settling = threading.Event()
+    settling.set()
+    latencies, errors = [], []
+    writers = [threading.Thread(target=writer, args=(i, pin_key, settling, latencies, errors))
+               for i in range(args.writers)]
+    for thread in writers:
+        thread.start()
+    time.sleep(1)  # let the writers log in
+
+    start = time.perf_counter()
+    status = admin.get('/run_lottery', base_url='https://localhost').status_code
+    job = job_queue.active('settle_round')
+    job_queue.run_one('benchmark')  # settle the queued round here, as a worker would
+    settled = job_queue.get(job['id'])['result']['draws']  # includes draws entered while settling
+    settlement_seconds = time.perf_counter() - start
+    settling.clear()
+    for thread in writers:
+        thread.join()
+
+    latencies.sort()
+    print('journal mode:         %s' % journal)
+    print('settlement:           %d draws in %.2fs (status %d)' % (settled, settlement_seconds, status))
+    print('create_draw:          %d ok, %d failed, %.1f/sec' % (len(latencies), len(errors),
+                                                               len(latencies) / settlement_seconds))
+    if latencies:
+        print('create_draw latency:  p50 %.1fms, p95 %.1fms, max %.1fms' % (
+            latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000,
+            latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
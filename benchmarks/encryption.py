@@ -0,0 +1,51 @@
+# Compare per-draw RSA encryption with data key (envelope) encryption of draw numbers.
+# Run from the project root: python -m benchmarks.encryption --draws 20000
+import argparse
+import time
+
+import numpy as np
+import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from benchmarks.matching import synthetic_draws
+from keys import generate_data_key, wrap_data_key, unwrap_data_key, seal, unseal
+
+
+def rate(label, count, fn):
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    print('%-24s %8d in %.2fs (%.0f/sec)' % (label, count, elapsed, count / elapsed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--draws', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--bits', type=int, default=512)
+    args = parser.parse_args()
+
+    draws = [value.encode('utf-8') for value in synthetic_draws(args.draws, np.random.default_rng(2031))]
+    public_key, private_key = rsa.newkeys(args.bits)
+
+    # per-draw RSA, as before data keys
+    encrypted = rate('rsa encrypt', len(draws), lambda: [rsa.encrypt(draw, public_key) for draw in draws])
+    rate('rsa decrypt', len(draws), lambda: [rsa.decrypt(ciphertext, private_key) for ciphertext in encrypted])
+
+    # data keys: settlement unwraps one key per user per batch, then decrypts each of their draws with it
+    wrapped = [wrap_data_key(generate_data_key(), public_key) for _ in range(args.users)]
+    ciphers = rate('unwrap data keys', args.users,
+                   lambda: [AESGCM(unwrap_data_key(key, private_key)) for key in wrapped])
+    sealed = rate('envelope encrypt', len(draws),
+                  lambda: [seal(ciphers[i % args.users], draw) for i, draw in enumerate(draws)])
+    opened = rate('envelope decrypt', len(draws),
+                  lambda: [unseal(ciphers[i % args.users], ciphertext) for i, ciphertext in enumerate(sealed)])
+
+    assert opened == draws
+    print('ciphertext size: rsa %d bytes, envelope %d-%d bytes' % (
+        len(encrypted[0]), min(map(len, sealed)), max(map(len, sealed))))
+
+
+if __name__ == '__main__':
+    main()
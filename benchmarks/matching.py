@@ -0,0 +1,47 @@
+# Benchmark vectorised prize-tier matching over synthetic draws.
+# Run from the project root: python -m benchmarks.matching --entries 1000000
+import argparse
+import time
+
+import numpy as np
+
+from lottery.numbers import DRAW_SIZE, MAX_NUMBER, PRIZE_TIERS, masks_from_strings, match_counts, numbers_to_mask
+
+
+# random draws of 6 unique numbers as the space separated strings settlement decrypts
+def synthetic_draws(entries, rng, batch_size=100000):
+    draws = []
+    for start in range(0, entries, batch_size):
+        size = min(batch_size, entries - start)
+        numbers = np.sort(np.argsort(rng.random((size, MAX_NUMBER)), axis=1)[:, :DRAW_SIZE] + 1, axis=1)
+        draws += [' '.join(map(str, row)) for row in numbers.tolist()]
+    return draws
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(2031)
+    draws = synthetic_draws(args.entries, rng)
+    winning_mask = numbers_to_mask(synthetic_draws(1, rng)[0].split())
+
+    started = time.perf_counter()
+    tiers = {tier: 0 for tier in PRIZE_TIERS}
+    for start in range(0, len(draws), args.chunk_size):
+        counts = match_counts(masks_from_strings(draws[start:start + args.chunk_size]), winning_mask)
+        for tier, total in zip(*np.unique(counts, return_counts=True)):
+            if int(tier) in tiers:
+                tiers[int(tier)] += int(total)
+    elapsed = time.perf_counter() - started
+
+    print('%d entries matched in %.2fs (%.0f entries/sec), chunk size %d' % (
+        args.entries, elapsed, args.entries / elapsed, args.chunk_size))
+    for tier, total in tiers.items():
+        print('  %d matches: %d winners' % (tier, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Measure rows and bytes fetched from the database and ORM instances hydrated per endpoint.
+# Run from the project root: python -m benchmarks.queries --users 1000
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+workdir = tempfile.mkdtemp()
+database = os.path.join(workdir, 'benchmark.db')
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database
+os.environ['SQLALCHEMY_ECHO'] = 'False'
+os.environ.setdefault('KEYPAIR_POOL_SIZE', '0')
+sys.path.insert(0, os.getcwd())
+os.chdir(workdir)  # keep the benchmark's security log out of the project
+
+import pyotp  # noqa: E402
+from sqlalchemy import event, insert  # noqa: E402
+
+from app import app, db  # noqa: E402
+from models import User, init_db  # noqa: E402
+
+
+class Counter:
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.bytes = 0
+        self.hydrated = 0
+
+    def reset(self):
+        self.__init__()
+
+
+counter = Counter()
+raw = None
+
+
+# re-run each SELECT on a separate connection to measure what it returned
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if statement.lstrip().upper().startswith('SELECT'):
+        counter.queries += 1
+        for row in raw.execute(statement, parameters):
+            counter.rows += 1
+            counter.bytes += sum(len(value) if isinstance(value, (str, bytes)) else 8 for value in row
+                                 if value is not None)
+
+
+def hydrated(target, context, attrs=None):
+    counter.hydrated += 1
+
+
+def create_users(count):
+    with app.app_context():
+        # one keypair and password hash for all benchmark users, neither is being measured
+        template = User(email='template@email.com', firstname='Bench', lastname='User', date_of_birth='01/01/2000',
+                        postcode='NE1 7RU', phone='1234-123-1234', password='Bench1!', role='user')
+        columns = ('firstname', 'lastname', 'date_of_birth', 'postcode', 'phone', 'password', 'role', 'registered_on',
+                   'total_logins', 'draw_key', 'public_draw_key', 'private_draw_key')
+        values = {column: getattr(template, column) for column in columns}
+        db.session.execute(insert(User), [dict(values, email='user%d@email.com' % i) for i in range(count)])
+        db.session.commit()
+
+
+def login(client, email, password, pin_key):
+    page = client.get('/login', base_url='https://localhost').data.decode()
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+    return client.post('/login', base_url='https://localhost',
+                       data={'csrf_token': token, 'email': email, 'password': password, 'postcode': 'NE1 7RU',
+                             'pin': pyotp.TOTP(pin_key).now()})
+
+
+def main():
+    global raw
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    app.config['TESTING'] = True  # skips reCAPTCHA verification
+    init_db()
+    create_users(args.users)
+
+    raw = sqlite3.connect(database)
+    with app.app_context():
+        event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+        admin = User.query.filter_by(role='admin').first()
+        pin_key = admin.pin_key
+    event.listen(db.Model, 'load', hydrated, propagate=True)
+    event.listen(db.Model, 'refresh', hydrated, propagate=True)
+
+    client = app.test_client()
+    print('%-22s %8s %8s %12s %9s' % ('endpoint', 'queries', 'rows', 'bytes', 'hydrated'))
+    for endpoint in ('login', '/admin', '/view_all_users', '/view_user_activity', '/account'):
+        counter.reset()
+        if endpoint == 'login':
+            login(client, 'admin@email.com', 'Admin1!', pin_key)
+        else:
+            client.get(endpoint, base_url='https://localhost')
+        print('%-22s %8d %8d %12d %9d' % (endpoint, counter.queries, counter.rows, counter.bytes, counter.hydrated))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Benchmark settling a lottery round of synthetic entries end to end: decrypting the draws, matching them, the bulk
+# UPDATEs of each chunk and storing the per-tier results.
+# Run from the project root: python -m benchmarks.settlement --entries 1000000 --workers 4
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.matching import synthetic_draws
+
+
+# users sharing one keypair and password hash (neither is being measured), with entries spread over them
+def seed_round(app, db, entries, users, batch_size=50000):
+    from sqlalchemy import insert
+    from models import User, Draw, Round, encrypt, encrypt_many
+
+    with app.app_context():
+        template = User(email='template@email.com', firstname='Bench', lastname='User', date_of_birth='01/01/2000',
+                        postcode='NE1 7RU', phone='1234-123-1234', password='Bench1!', role='user')
+        columns = ('firstname', 'lastname', 'date_of_birth', 'postcode', 'phone', 'password', 'role', 'registered_on',
+                   'total_logins', 'draw_key', 'public_draw_key', 'private_draw_key')
+        values = {column: getattr(template, column) for column in columns}
+        db.session.execute(insert(User), [dict(values, email='user%d@email.com' % i) for i in range(users)])
+        user_ids = [user_id for user_id, in db.session.query(User.id).filter(User.email.like('user%'))]
+
+        rng = np.random.default_rng(2031)
+        for start in range(0, entries, batch_size):
+            encrypted = encrypt_many(synthetic_draws(min(batch_size, entries - start), rng), template.draw_key,
+                                     template.private_draw_key)
+            db.session.execute(insert(Draw), [{'user_id': user_ids[(start + i) % len(user_ids)], 'numbers': numbers,
+                                               'been_played': False, 'matches_master': False, 'match_count': 0}
+                                              for i, numbers in enumerate(encrypted)])
+            db.session.commit()
+
+        admin = User.query.filter_by(role='admin').one()
+        winning_numbers = synthetic_draws(1, rng)[0]
+        current_round = Round(admin.id, encrypt(winning_numbers, admin.draw_key, admin.private_draw_key, admin.id))
+        db.session.add(current_round)
+        db.session.commit()
+        return current_round.id
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--decrypt-chunk-size', type=int, default=250)
+    parser.add_argument('--journal', default='WAL')
+    args = parser.parse_args()
+
+    # the app is configured from the environment when it's imported, which happens here rather than at the top of
+    # the module: settlement's spawned worker processes import this module again
+    workdir = tempfile.mkdtemp()
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'benchmark.db')
+    os.environ['SQLALCHEMY_ECHO'] = 'False'
+    os.environ['SQLITE_JOURNAL_MODE'] = args.journal
+    os.environ.setdefault('KEYPAIR_POOL_SIZE', '0')
+    sys.path.insert(0, os.getcwd())
+    os.chdir(workdir)  # keep the benchmark's security log out of the project
+
+    from app import app, db
+    from admin.settlement import settle_draws
+    from models import User, Round, RoundResult, decrypt, init_db
+
+    init_db()
+    started = time.perf_counter()
+    round_id = seed_round(app, db, args.entries, args.users)
+    print('seeded:     %d encrypted entries from %d users in %.2fs' % (args.entries, args.users,
+                                                                     time.perf_counter() - started))
+
+    def progress(processed, total, checkpoint):
+        if processed == total or processed % (args.chunk_size * 100) == 0:
+            print('  %d/%d settled' % (processed, total))
+
+    with app.app_context():
+        current_round = db.session.get(Round, round_id)
+        admin = db.session.get(User, current_round.user_id)
+        winning_numbers = decrypt(current_round.numbers, admin.draw_key, admin.private_draw_key, admin.id)
+        stats = settle_draws(current_round, winning_numbers, args.chunk_size, args.workers, args.decrypt_chunk_size,
+                             progress)
+
+        print('settlement: %(draws)d entries in %(seconds).2fs (%(draws_per_second).0f entries/sec)' % stats)
+        print('            chunk size %d, %d workers, decrypt chunk size %d' % (args.chunk_size, args.workers,
+                                                                               args.decrypt_chunk_size))
+        for result in RoundResult.query.filter_by(lottery_round=round_id).order_by(RoundResult.tier.desc()):
+            print('  %d matches: %d winners' % (result.tier, result.winner_count))
+
+
+if __name__ == '__main__':
+    main()
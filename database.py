@@ -0,0 +1,65 @@
+# IMPORTS
+import sqlite3
+
+from sqlalchemy import event, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+
+
+def is_sqlite(uri):
+    return bool(uri) and make_url(uri).get_backend_name() == 'sqlite'
+
+
+def engine_options(uri, config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database
+
+    Server databases get a sized connection pool whose connections are checked before use and replaced
+    periodically. SQLite connections are tuned with pragmas instead (see configure_engine).
+    """
+    if not uri:
+        return {}
+
+    if is_sqlite(uri):
+        # wait for a lock (in seconds) rather than failing straight away with 'database is locked'
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}}
+
+    return {'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            'pool_recycle': config['DB_POOL_RECYCLE'],
+            'pool_pre_ping': True}
+
+
+def configure_engine(engine, config):
+    """Set the SQLite pragmas on every new connection of engine (other databases are left as they are)"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers carry on while settlement writes, and NORMAL only syncs at checkpoints in WAL mode
+        cursor.execute('PRAGMA journal_mode=%s' % config['SQLITE_JOURNAL_MODE'])
+        cursor.execute('PRAGMA synchronous=%s' % config['SQLITE_SYNCHRONOUS'])
+        cursor.execute('PRAGMA busy_timeout=%d' % config['SQLITE_BUSY_TIMEOUT'])
+        cursor.execute('PRAGMA mmap_size=%d' % config['SQLITE_MMAP_SIZE'])
+        cursor.close()
+
+
+# INSERT for the dialect that supports ON CONFLICT DO UPDATE (same interface on SQLite and PostgreSQL),
+# None on databases without it
+def upsert_insert(dialect, table):
+    if dialect.name == 'sqlite':
+        return sqlite.insert(table)
+    if dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return None
+
+
+# expression truncating a timestamp column to the hour (SQLite has no date_trunc, so hours are formatted strings there)
+def hour_bucket(dialect, column):
+    if dialect.name == 'sqlite':
+        return func.strftime('%Y-%m-%d %H:00', column)
+    return func.date_trunc('hour', column)
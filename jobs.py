@@ -0,0 +1,179 @@
+# IMPORTS
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import click
+
+from app import app
+
+# job handlers by kind, registered with @job_handler
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """Register fn(job, report) to run jobs of a kind, report(processed, total, checkpoint) records progress"""
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+
+    return register
+
+
+class LeaseLost(Exception):
+    """The job was taken over by another worker after this worker's lease expired"""
+
+
+class JobQueue:
+    """Jobs in a local SQLite database, run by worker processes started with 'flask worker'
+
+    At most one job per key is queued or running at a time, so a key acts as a lock (e.g. one settlement per round).
+    Running jobs renew a lease with every progress report, a job whose lease has expired is picked up again by
+    another worker and resumes from its last checkpoint. From then on the first worker's updates to the job fail with
+    LeaseLost, so only one worker runs a job at a time.
+    """
+
+    def __init__(self, path, lease=60):
+        self.path = path
+        self.lease = lease
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS jobs '
+                           '(id INTEGER PRIMARY KEY, kind TEXT NOT NULL, key TEXT NOT NULL, payload TEXT NOT NULL, '
+                           'status TEXT NOT NULL, processed INTEGER NOT NULL DEFAULT 0, total INTEGER, '
+                           'checkpoint TEXT, result TEXT, error TEXT, worker TEXT, created REAL NOT NULL, '
+                           'started REAL, expires REAL, finished REAL)')
+        # the per-key lock: one queued or running job for each key
+        connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_jobs_active_key ON jobs (key) "
+                           "WHERE status IN ('queued', 'running')")
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, id)')
+
+    # one connection per thread, sqlite3 connections can't be shared between threads
+    def _connection(self):
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.connection.row_factory = sqlite3.Row
+        return self._local.connection
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        for column in ('payload', 'checkpoint', 'result'):
+            job[column] = json.loads(job[column]) if job[column] is not None else None
+        return job
+
+    def enqueue(self, kind, key, payload):
+        """Queue a job, returns (job id, False), or (id of the job already holding key, True)"""
+        connection = self._connection()
+        while True:
+            try:
+                cursor = connection.execute('INSERT INTO jobs (kind, key, payload, status, created) '
+                                            "VALUES (?, ?, ?, 'queued', ?)",
+                                            (kind, key, json.dumps(payload), time.time()))
+                return cursor.lastrowid, False
+            except sqlite3.IntegrityError:
+                # retry if the job holding the key finished in the meantime
+                job = self.active(key)
+                if job is not None:
+                    return job['id'], True
+
+    def active(self, key):
+        return self._job(self._connection().execute("SELECT * FROM jobs WHERE key = ? AND status IN "
+                                                    "('queued', 'running')", (key,)).fetchone())
+
+    def get(self, job_id):
+        return self._job(self._connection().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def claim(self, worker):
+        """Take the oldest queued job, or a running job whose worker stopped renewing its lease"""
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute("SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND "
+                                     'expires < ?) ORDER BY id LIMIT 1', (now,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET status = 'running', worker = ?, started = COALESCE(started, ?), "
+                                   'expires = ? WHERE id = ?', (worker, now, now + self.lease, row['id']))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return self.get(row['id']) if row is not None else None
+
+    # jobs are only updated by the worker holding them, raises LeaseLost once another worker has taken a job over
+    def _update(self, job_id, worker, assignments, values):
+        cursor = self._connection().execute("UPDATE jobs SET %s WHERE id = ? AND worker = ? AND status = 'running'"
+                                            % assignments, values + (job_id, worker))
+        if cursor.rowcount == 0:
+            raise LeaseLost('Job %s is no longer held by %s' % (job_id, worker))
+
+    def report(self, job_id, worker, processed, total, checkpoint):
+        self._update(job_id, worker, 'processed = ?, total = ?, checkpoint = ?, expires = ?',
+                     (processed, total, json.dumps(checkpoint), time.time() + self.lease))
+
+    def finish(self, job_id, worker, result):
+        self._update(job_id, worker, "status = 'done', result = ?, finished = ?", (json.dumps(result), time.time()))
+
+    def fail(self, job_id, worker, error):
+        self._update(job_id, worker, "status = 'failed', error = ?, finished = ?", (error, time.time()))
+
+    def run_one(self, worker):
+        """Claim and run one job, returns False if there was nothing to run"""
+        job = self.claim(worker)
+        if job is None:
+            return False
+
+        # progress reports raise LeaseLost to stop the handler once another worker has the job
+        def report(processed, total, checkpoint):
+            self.report(job['id'], worker, processed, total, checkpoint)
+
+        try:
+            with app.app_context():
+                result = HANDLERS[job['kind']](job, report)
+            self.finish(job['id'], worker, result)
+        except LeaseLost:
+            logging.warning('Job %s (%s) was taken over by another worker', job['id'], job['kind'])
+        except Exception as e:
+            logging.exception('Job %s (%s) failed', job['id'], job['kind'])
+            try:
+                self.fail(job['id'], worker, '%s: %s' % (type(e).__name__, e))
+            except LeaseLost:
+                pass
+        return True
+
+
+# progress of a job for polling clients: processed/total, rate and estimated seconds remaining
+def job_progress(job):
+    progress = {'id': job['id'], 'kind': job['kind'], 'status': job['status'], 'processed': job['processed'],
+                'total': job['total'], 'rate': None, 'eta_seconds': None, 'result': job['result'],
+                'error': job['error']}
+
+    if job['status'] == 'running' and job['processed'] and job['total']:
+        rate = job['processed'] / max(time.time() - job['started'], 1e-6)
+        progress['rate'] = rate
+        progress['eta_seconds'] = max(job['total'] - job['processed'], 0) / rate
+    return progress
+
+
+# background jobs shared by the app and its workers
+job_queue = JobQueue(app.config['JOBS_DATABASE'], app.config['JOB_LEASE'])
+
+
+# run queued jobs until stopped: flask worker
+@app.cli.command('worker')
+@click.option('--once', is_flag=True, help='Exit once there are no queued jobs.')
+def worker_command(once):
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    click.echo('Worker %s waiting for jobs' % worker)
+    while True:
+        if not job_queue.run_one(worker):
+            if once:
+                return
+            time.sleep(app.config['JOB_POLL_INTERVAL'])
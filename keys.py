@@ -0,0 +1,162 @@
+# IMPORTS
+import hashlib
+import os
+import pickle
+import queue
+import threading
+import time
+
+import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from cache import LRUCache
+
+# pickle protocol 2+ streams start with the PROTO opcode, DER keys start with a SEQUENCE tag (0x30)
+PICKLE_PROTO = b'\x80'
+
+# versioned ciphertexts start with their format version:
+# 1 = AES-256-GCM under the owner's data key, followed by a 12 byte nonce and the sealed data (with its 16 byte tag)
+# unversioned RSA ciphertexts from before data keys are always exactly the size of the owner's modulus (64 bytes),
+# sealed draw numbers are at most 46 bytes so the two can't be confused
+ENVELOPE_V1 = 1
+NONCE_SIZE = 12
+
+# format new ciphertexts are written in, older ones are rewritten by 'flask reencrypt-draws'
+CIPHERTEXT_VERSION = ENVELOPE_V1
+
+
+# serialise an RSA key in compact DER (PKCS#1) form for storage
+def dump_key(key):
+    return key.save_pkcs1('DER')
+
+
+# load a stored public key (DER, or pickled by older versions of the app)
+def load_public_key(data):
+    if data[:1] == PICKLE_PROTO:
+        return pickle.loads(data)
+    return rsa.PublicKey.load_pkcs1(data, 'DER')
+
+
+# load a stored private key (DER, or pickled by older versions of the app)
+def load_private_key(data):
+    if data[:1] == PICKLE_PROTO:
+        return pickle.loads(data)
+    return rsa.PrivateKey.load_pkcs1(data, 'DER')
+
+
+# short fingerprint of a stored key, changes whenever the key does
+def key_fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+# new random data key for a user's draws
+def generate_data_key():
+    return AESGCM.generate_key(bit_length=256)
+
+
+# data keys are stored encrypted with the user's RSA public key
+def wrap_data_key(data_key, public_key):
+    return rsa.encrypt(data_key, public_key)
+
+
+def unwrap_data_key(wrapped_key, private_key):
+    return rsa.decrypt(wrapped_key, private_key)
+
+
+# RSA ciphertext from before data keys (see ENVELOPE_V1)
+def is_rsa_ciphertext(ciphertext, private_key):
+    return len(ciphertext) == rsa.common.byte_size(private_key.n)
+
+
+# format version of a stored ciphertext, 0 for RSA ciphertexts from before data keys
+def ciphertext_version(ciphertext, private_key):
+    return 0 if is_rsa_ciphertext(ciphertext, private_key) else ciphertext[0]
+
+
+# encrypt with a data key cipher (AESGCM), the version byte is authenticated along with the data
+def seal(cipher, plaintext):
+    header = bytes([CIPHERTEXT_VERSION])
+    nonce = os.urandom(NONCE_SIZE)
+    return header + nonce + cipher.encrypt(nonce, plaintext, header)
+
+
+def unseal(cipher, ciphertext):
+    if ciphertext[0] != ENVELOPE_V1:
+        raise ValueError('Unsupported ciphertext version %d' % ciphertext[0])
+    return cipher.decrypt(ciphertext[1:1 + NONCE_SIZE], ciphertext[1 + NONCE_SIZE:], ciphertext[:1])
+
+
+class KeyCache:
+    """Deserialised RSA keys and unwrapped data key ciphers keyed by user id and key fingerprint"""
+
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize)
+
+    def public_key(self, user_id, data):
+        return self._cache.get_or_load((user_id, 'public', key_fingerprint(data)), lambda: load_public_key(data))
+
+    def private_key(self, user_id, data):
+        return self._cache.get_or_load((user_id, 'private', key_fingerprint(data)), lambda: load_private_key(data))
+
+    # data key cipher, unwrapped with the user's private key the first time it's needed
+    def data_key(self, user_id, wrapped_key, private_key):
+        return self._cache.get_or_load((user_id, 'data', key_fingerprint(wrapped_key)),
+                                       lambda: AESGCM(unwrap_data_key(wrapped_key,
+                                                                      self.private_key(user_id, private_key))))
+
+    # drop all cached keys for a user (e.g. when their keys are replaced)
+    def invalidate(self, user_id):
+        self._cache.invalidate(lambda key: key[0] == user_id)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class KeypairPool:
+    """Pre-generated RSA keypairs, kept topped up by a background thread"""
+
+    def __init__(self, size, bits=512):
+        self.size = size
+        self.bits = bits
+        self.generated = 0
+        self.generation_seconds = 0.0
+        self.taken = 0
+        self.fallbacks = 0
+        self._keypairs = queue.Queue(maxsize=max(size, 1))
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.size > 0 and self._thread is None:
+                self._thread = threading.Thread(target=self._refill, name='keypair-pool', daemon=True)
+                self._thread.start()
+
+    def _refill(self):
+        while True:
+            started = time.perf_counter()
+            keypair = rsa.newkeys(self.bits)
+            self.generation_seconds += time.perf_counter() - started
+            self.generated += 1
+
+            # blocks while the pool is full
+            self._keypairs.put(keypair)
+
+    # take a (public, private) keypair, generating one inline only if the pool is empty
+    def take(self):
+        self.start()
+        try:
+            keypair = self._keypairs.get_nowait()
+            self.taken += 1
+            return keypair
+        except queue.Empty:
+            self.fallbacks += 1
+            return rsa.newkeys(self.bits)
+
+    def stats(self):
+        return {'depth': self._keypairs.qsize() if self.size > 0 else 0,
+                'size': self.size,
+                'generated': self.generated,
+                'taken': self.taken,
+                'fallbacks': self.fallbacks,
+                'refill_rate': self.generated / self.generation_seconds if self.generation_seconds else 0.0}
@@ -0,0 +1,85 @@
+# IMPORTS
+import numpy as np
+
+# numbers per draw and the highest number that can be drawn (1-60 fits in a 64-bit mask)
+DRAW_SIZE = 6
+MAX_NUMBER = 60
+
+# prize tiers by number of matches with the winning draw
+PRIZE_TIERS = (6, 5, 4, 3)
+
+
+# canonical 60-bit encoding of a draw: bit (n - 1) is set for each number n
+def numbers_to_mask(numbers):
+    mask = 0
+    for number in numbers:
+        mask |= 1 << (int(number) - 1)
+    return mask
+
+
+# numbers encoded in a mask, in ascending order
+def mask_to_numbers(mask):
+    return [number for number in range(1, MAX_NUMBER + 1) if mask >> (number - 1) & 1]
+
+
+# canonical display form of a draw (ascending, space separated)
+def numbers_to_string(numbers):
+    return ' '.join(str(number) for number in mask_to_numbers(numbers_to_mask(numbers)))
+
+
+# masks for a batch of draw strings ('1 2 3 4 5 6'), parsed and encoded in one vectorised pass
+def masks_from_strings(draws):
+    if not draws:
+        return np.zeros(0, dtype=np.uint64)
+    numbers = np.array(' '.join(draws).split(), dtype=np.uint64).reshape(-1, DRAW_SIZE)
+    return np.bitwise_or.reduce(np.left_shift(np.uint64(1), numbers - np.uint64(1)), axis=1)
+
+
+# number of matching numbers between each mask and the winning mask
+def match_counts(masks, winning_mask):
+    return np.bitwise_count(np.bitwise_and(masks, np.uint64(winning_mask))).astype(np.int8)
+
+
+# a submitted draw number as an int: ints (not bools, which are ints too) and strings of digits only, so floats
+# like 7.9 and strings like '7.0' or ' 7' aren't quietly converted into a different draw
+def whole_number(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    raise ValueError('not a whole number: %r' % (value,))
+
+
+# validate many submitted draws in one vectorised pass (range, uniqueness) and sort them
+# returns (line indexes of valid draws, sorted valid draws as an array, {line index: error})
+def validate_draws(lines):
+    errors = {}
+    rows = []
+    indexes = []
+
+    # shape and type checks need to look at each line
+    for index, line in enumerate(lines):
+        if not isinstance(line, (list, tuple)) or len(line) != DRAW_SIZE:
+            errors[index] = 'Draw must contain exactly %d numbers' % DRAW_SIZE
+            continue
+        try:
+            row = [whole_number(number) for number in line]
+        except ValueError:
+            errors[index] = 'Draw numbers must be whole numbers'
+            continue
+        # numbers outside the range only need to stay outside it (and fit in an int64) for the range check below
+        rows.append([min(max(number, 0), MAX_NUMBER + 1) for number in row])
+        indexes.append(index)
+
+    indexes = np.array(indexes, dtype=np.int64)
+    numbers = np.sort(np.array(rows, dtype=np.int64).reshape(-1, DRAW_SIZE), axis=1)
+    out_of_range = np.any((numbers < 1) | (numbers > MAX_NUMBER), axis=1)
+    duplicates = np.any(np.diff(numbers, axis=1) == 0, axis=1) & ~out_of_range
+
+    for index in indexes[out_of_range].tolist():
+        errors[index] = 'Draw numbers must be between 1 and %d' % MAX_NUMBER
+    for index in indexes[duplicates].tolist():
+        errors[index] = 'You cannot have duplicate numbers'
+
+    valid = ~(out_of_range | duplicates)
+    return indexes[valid].tolist(), numbers[valid], errors
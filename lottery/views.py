@@ -1,16 +1,45 @@
 # IMPORTS
-from flask import Blueprint, render_template, flash, redirect, url_for
+import csv
+import io
+import json
+
+from flask import Blueprint, render_template, flash, redirect, url_for, request, current_app, Response, \
+    stream_with_context, jsonify
 from flask_login import login_required, current_user
+from flask_wtf.csrf import validate_csrf
+from sqlalchemy import insert
 from sqlalchemy.orm import make_transient
+from wtforms import ValidationError
 
 from app import db, requires_roles
 from lottery.forms import DrawForm
-from models import Draw, encrypt
+from lottery.numbers import numbers_to_string, validate_draws
+from models import Draw, RoundResult, encrypt, encrypt_many, decrypt, archive_draws, user_draws, exported_draws, \
+    draws_after
 
 # CONFIG
 lottery_blueprint = Blueprint('lottery', __name__, template_folder='templates')
 
 
+# page size requested by the client, bounded by the configured maximum
+def page_size():
+    per_page = request.values.get('per_page', current_app.config['DRAWS_PAGE_SIZE'], type=int)
+    return max(1, min(per_page, current_app.config['DRAWS_MAX_PAGE_SIZE']))
+
+
+# next page of draws after the draw id given in the request (keyset pagination), returns (draws, next after id)
+def draws_page(query):
+    after = request.values.get('after', 0, type=int)
+    per_page = page_size()
+
+    # fetch one extra draw to find out whether there is another page
+    draws = draws_after(query, after, per_page + 1).all()
+
+    if len(draws) > per_page:
+        return draws[:per_page], draws[per_page - 1].id
+    return draws, None
+
+
 # VIEWS
 # view lottery page
 @lottery_blueprint.route('/lottery')
@@ -28,24 +57,16 @@ def create_draw():
     form = DrawForm()
 
     if form.validate_on_submit():
-        # sort in ascending order
-        sorted_submitted_numbers = sorted([form.number1.data, form.number2.data, form.number3.data,
-                                           form.number4.data, form.number5.data, form.number6.data])
-        
-        # convert to string
-        submitted_numbers_string = ' '.join([str(number) for number in sorted_submitted_numbers])
+        # convert to canonical string (ascending order, via the draw's bitmask encoding)
+        submitted_numbers_string = numbers_to_string([form.number1.data, form.number2.data, form.number3.data,
+                                                      form.number4.data, form.number5.data, form.number6.data])
 
         # encrypt submitted numbers with user's draw key
-
-        # Symmetric
-        # submitted_numbers_encrypted = encrypt(submitted_numbers_string, current_user.draw_key)
-
-        # Asymmetric
-        submitted_numbers_encrypted = encrypt(submitted_numbers_string, current_user.public_draw_key)
+        submitted_numbers_encrypted = encrypt(submitted_numbers_string, current_user.draw_key,
+                                              current_user.private_draw_key, current_user.id)
 
         # create a new draw with the form data.
-        new_draw = Draw(user_id=current_user.id, numbers=submitted_numbers_encrypted, master_draw=False,
-                        lottery_round=0)
+        new_draw = Draw(user_id=current_user.id, numbers=submitted_numbers_encrypted)
         # add the new draw to the database
         db.session.add(new_draw)
         db.session.commit()
@@ -62,23 +83,19 @@ def create_draw():
 @requires_roles('user')
 @lottery_blueprint.route('/view_draws', methods=['POST'])
 def view_draws():
-    # get all draws that have not been played [played=0] by the current user
-    playable_draws = Draw.query.filter_by(been_played=False, user_id=current_user.id).all()
+    # get next page of draws that have not been played [played=0] by the current user
+    playable_draws, next_after = draws_page(user_draws(current_user.id, played=False))
 
     # if playable draws exist
     if len(playable_draws) != 0:
-        # decrypt draws
+        # decrypt draws on this page only
         for draw in playable_draws:
             make_transient(draw)
-
-            # Symmetric
-            # draw.view_draw(current_user.draw_key)
-
-            # Asymmetric
-            draw.view_draw(current_user.private_draw_key)
+            draw.view_draw(current_user.draw_key, current_user.private_draw_key)
 
         # re-render lottery page with playable draws
-        return render_template('lottery/lottery.html', playable_draws=playable_draws)
+        return render_template('lottery/lottery.html', playable_draws=playable_draws, playable_after=next_after,
+                               per_page=page_size())
     else:
         flash('No playable draws.')
         return lottery()
@@ -89,12 +106,20 @@ def view_draws():
 @requires_roles('user')
 @lottery_blueprint.route('/check_draws', methods=['POST'])
 def check_draws():
-    # get played draws by current user, don't need to decrypt as played draws already decrypted
-    played_draws = Draw.query.filter_by(been_played=True, user_id=current_user.id).all()
+    # get next page of played draws by current user, don't need to decrypt as played draws already decrypted
+    played_draws, next_after = draws_page(user_draws(current_user.id, played=True))
 
     # if played draws exist
     if len(played_draws) != 0:
-        return render_template('lottery/lottery.html', results=played_draws, played=True)
+        # get precomputed winner counts per prize tier for the rounds played
+        rounds = {draw.lottery_round for draw in played_draws}
+        round_results = RoundResult.query.with_entities(RoundResult.lottery_round, RoundResult.tier,
+                                                        RoundResult.winner_count) \
+            .filter(RoundResult.lottery_round.in_(rounds)) \
+            .order_by(RoundResult.lottery_round, RoundResult.tier.desc()).all()
+
+        return render_template('lottery/lottery.html', results=played_draws, round_results=round_results,
+                               results_after=next_after, per_page=page_size(), played=True)
 
     # if no played draws exist [all draw entries have been played therefore wait for next lottery round]
     else:
@@ -102,14 +127,100 @@ def check_draws():
         return lottery()
 
 
-# delete all played draws
+# submit many draws at once as a JSON array of draws or CSV (one draw per line)
+@lottery_blueprint.route('/create_draws_bulk', methods=['POST'])
+@login_required
+@requires_roles('user')
+def create_draws_bulk():
+    if request.is_json:
+        lines = request.get_json(silent=True)
+        if isinstance(lines, dict):
+            lines = lines.get('draws')
+        if not isinstance(lines, list):
+            return jsonify(error='Expected a JSON array of draws'), 400
+
+    elif request.mimetype in ('text/csv', 'multipart/form-data'):
+        if request.mimetype == 'multipart/form-data':
+            # uploads from forms must carry the form's CSRF token
+            try:
+                validate_csrf(request.form.get('csrf_token'))
+            except ValidationError:
+                return jsonify(error='Missing or invalid CSRF token'), 400
+            if 'file' not in request.files:
+                return jsonify(error='Expected a CSV file upload'), 400
+            content = request.files['file'].read().decode('utf-8', errors='replace')
+        else:
+            content = request.get_data(as_text=True)
+        # spreadsheets and people write '1, 2, 3', only the JSON values themselves must be exact
+        lines = [[cell.strip() for cell in row] for row in csv.reader(io.StringIO(content))]
+
+    else:
+        return jsonify(error='Expected application/json or text/csv'), 415
+
+    if len(lines) > current_app.config['BULK_DRAWS_MAX_LINES']:
+        return jsonify(error='At most %d draws per request' % current_app.config['BULK_DRAWS_MAX_LINES']), 413
+
+    # validate and sort all lines in one vectorised pass
+    indexes, numbers, errors = validate_draws(lines)
+
+    if indexes:
+        # encrypt with a single key load and insert with a single bulk insert
+        encrypted = encrypt_many([' '.join(map(str, row)) for row in numbers.tolist()], current_user.draw_key,
+                                 current_user.private_draw_key, current_user.id)
+        db.session.execute(insert(Draw), [{'user_id': current_user.id,
+                                           'numbers': numbers_encrypted,
+                                           'been_played': False,
+                                           'matches_master': False,
+                                           'match_count': 0}
+                                          for numbers_encrypted in encrypted])
+        db.session.commit()
+
+    return jsonify(accepted=len(indexes),
+                   rejected=len(errors),
+                   errors=[{'line': index + 1, 'error': error} for index, error in sorted(errors.items())])
+
+
+# stream all of the current user's draws as NDJSON (one draw per line), decrypting in batches
+@lottery_blueprint.route('/export_draws')
+@login_required
+@requires_roles('user')
+def export_draws():
+    user_id = current_user.id
+    draw_key = current_user.draw_key
+    private_key = current_user.private_draw_key
+    batch_size = current_app.config['DRAWS_MAX_PAGE_SIZE']
+
+    def generate():
+        after = 0
+        while True:
+            draws = draws_after(exported_draws(user_id), after, batch_size).all()
+
+            if not draws:
+                return
+
+            for draw in draws:
+                # played draws are already stored decrypted
+                numbers = draw.numbers if draw.been_played else decrypt(draw.numbers, draw_key, private_key, user_id)
+
+                yield json.dumps({'id': draw.id,
+                                  'numbers': numbers,
+                                  'been_played': draw.been_played,
+                                  'lottery_round': draw.lottery_round,
+                                  'match_count': draw.match_count,
+                                  'matches_master': draw.matches_master}) + '\n'
+
+            after = draws[-1].id
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+# archive all played draws
 @login_required
 @requires_roles('user')
 @lottery_blueprint.route('/play_again', methods=['POST'])
 def play_again():
-    # Delete played draws by current user
-    Draw.query.filter_by(been_played=True, master_draw=False, user_id=current_user.id).delete(synchronize_session=False)
-    db.session.commit()
+    # Move played draws by current user into the draws archive
+    archive_draws(Draw.user_id == current_user.id)
 
-    flash("All played draws deleted.")
+    flash("All played draws cleared.")
     return lottery()
@@ -1,12 +1,26 @@
-import pickle
-from datetime import datetime
+from datetime import datetime, timedelta
 
-import bcrypt
 import pyotp
 import rsa
 from flask_login import UserMixin
+from sqlalchemy import event, inspect, insert, update, delete, func, case
+from sqlalchemy.orm import deferred
 
 from app import db, app
+from database import upsert_insert
+from keys import KeyCache, KeypairPool, CIPHERTEXT_VERSION, dump_key, generate_data_key, wrap_data_key, \
+    is_rsa_ciphertext, ciphertext_version, seal, unseal
+from lottery.numbers import masks_from_strings
+from users.hashing import HashingPool
+
+# deserialised draw keys shared by all requests in this process
+key_cache = KeyCache(app.config['KEY_CACHE_SIZE'])
+
+# draw keypairs generated ahead of registration
+keypair_pool = KeypairPool(app.config['KEYPAIR_POOL_SIZE'], app.config['DRAW_KEY_BITS'])
+
+# password hashing off the request threads
+password_hasher = HashingPool(app.config['HASH_WORKERS'], app.config['HASH_QUEUE_SIZE'], app.config['BCRYPT_ROUNDS'])
 
 
 class User(db.Model, UserMixin):
@@ -16,7 +30,7 @@ class User(db.Model, UserMixin):
 
     # User authentication information.
     email = db.Column(db.String(100), nullable=False, unique=True)
-    password = db.Column(db.BLOB, nullable=False)
+    password = deferred(db.Column(db.BLOB, nullable=False), group='credentials')
     pin_key = db.Column(db.String(32), nullable=True, default=pyotp.random_base32())
 
     # User information
@@ -35,15 +49,22 @@ class User(db.Model, UserMixin):
     last_login_ip = db.Column(db.String(100), nullable=True)
     total_logins = db.Column(db.Integer, nullable=False, default=0)
 
-    # Symmetric key
-    # draw_key = db.Column(db.BLOB, nullable=False)
+    # Draw keys (only loaded when used, or with undefer_group('draw_keys'))
+    # Symmetric data key that draws are encrypted with, stored wrapped by the asymmetric keys
+    # (None for users registered before data keys, until 'flask reencrypt-draws' has run)
+    draw_key = deferred(db.Column(db.BLOB, nullable=True), group='draw_keys')
+    public_draw_key = deferred(db.Column(db.BLOB, nullable=False), group='draw_keys')
+    private_draw_key = deferred(db.Column(db.BLOB, nullable=False), group='draw_keys')
 
-    # Asymmetric keys
-    public_draw_key = db.Column(db.BLOB, nullable=False)
-    private_draw_key = db.Column(db.BLOB, nullable=False)
+    # Define the relationship to Draw (a query, so draws are never loaded with the user)
+    draws = db.relationship('Draw', lazy='dynamic')
 
-    # Define the relationship to Draw
-    draws = db.relationship('Draw')
+    __table_args__ = (
+        # admin user listings filter on role and sort by id, last login or login count
+        db.Index('ix_users_role', role),
+        db.Index('ix_users_role_current_login', role, current_login),
+        db.Index('ix_users_role_total_logins', role, total_logins),
+    )
 
     def __init__(self, email, firstname, lastname, date_of_birth, postcode, phone, password, role):
         self.email = email
@@ -52,7 +73,7 @@ class User(db.Model, UserMixin):
         self.date_of_birth = date_of_birth
         self.postcode = postcode
         self.phone = phone
-        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        self.password = password_hasher.hash_password(password)
         self.role = role
         self.registered_on = datetime.now()
         self.current_login = None
@@ -61,16 +82,16 @@ class User(db.Model, UserMixin):
         self.last_login_ip = None
         self.total_logins = 0
 
-        # Symmetric key
-        # self.draw_key = Fernet.generate_key()
-
         # Asymmetric keys
-        public_key, private_key = rsa.newkeys(512)
-        self.public_draw_key = pickle.dumps(public_key)
-        self.private_draw_key = pickle.dumps(private_key)
+        public_key, private_key = keypair_pool.take()
+        self.public_draw_key = dump_key(public_key)
+        self.private_draw_key = dump_key(private_key)
+
+        # Symmetric data key, wrapped with the public key
+        self.draw_key = wrap_data_key(generate_data_key(), public_key)
 
     def verify_password(self, password):
-        return bcrypt.checkpw(password.encode('utf-8'), self.password)
+        return password_hasher.check_password(password, self.password)
 
     def get_2fa_uri(self):
         return str(pyotp.totp.TOTP(self.pin_key).provisioning_uri(name=self.email, issuer_name='Lottery App'))
@@ -82,7 +103,67 @@ class User(db.Model, UserMixin):
         return self.postcode == postcode
 
     def change_password(self, new_password):
-        self.password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        self.password = password_hasher.hash_password(new_password)
+
+
+# cached keys must not outlive a change of key
+@event.listens_for(User.draw_key, 'set')
+@event.listens_for(User.public_draw_key, 'set')
+@event.listens_for(User.private_draw_key, 'set')
+def invalidate_draw_keys(target, value, oldvalue, initiator):
+    if target.id is not None:
+        key_cache.invalidate(target.id)
+
+
+class Round(db.Model):
+    __tablename__ = 'rounds'
+
+    # Lottery round number
+    id = db.Column(db.Integer, primary_key=True)
+
+    # ID of admin who generated the winning draw (numbers are encrypted with their draw key)
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+
+    # 6 winning numbers (stored decrypted once the round is settled)
+    numbers = db.Column(db.String(256), nullable=False)
+
+    # Round has been settled (user draws played against the winning numbers)
+    settled = db.Column(db.BOOLEAN, nullable=False, default=False)
+
+    # Round history
+    created_on = db.Column(db.DateTime, nullable=False)
+    settled_on = db.Column(db.DateTime, nullable=True)
+
+    # Settlement statistics
+    entries = db.Column(db.Integer, nullable=False, default=0)
+    winners = db.Column(db.Integer, nullable=False, default=0)
+    settlement_seconds = db.Column(db.Float, nullable=True)
+
+    # High-water mark of settlement: every unplayed draw up to this ID has been settled in this round
+    # (committed with each chunk, so an interrupted settlement resumes after it)
+    settled_through = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # at most one unsettled round
+        db.Index('uq_rounds_unsettled', settled, unique=True,
+                 sqlite_where=settled == False,  # noqa: E712
+                 postgresql_where=settled == False),  # noqa: E712
+    )
+
+    def __init__(self, user_id, numbers):
+        self.user_id = user_id
+        self.numbers = numbers
+        self.settled = False
+        self.created_on = datetime.now()
+        self.settled_on = None
+        self.entries = 0
+        self.winners = 0
+        self.settlement_seconds = None
+        self.settled_through = 0
+
+    # view winning numbers with the admin's draw keys
+    def view_numbers(self, draw_key, private_key):
+        self.numbers = decrypt(self.numbers, draw_key, private_key, self.user_id)
 
 
 class Draw(db.Model):
@@ -99,52 +180,320 @@ class Draw(db.Model):
     # Draw has already been played (can only play draw once)
     been_played = db.Column(db.BOOLEAN, nullable=False, default=False)
 
-    # Draw matches with master draw created by admin (True = draw is a winner)
+    # Draw matches the round's winning numbers (True = draw is a winner)
     matches_master = db.Column(db.BOOLEAN, nullable=False, default=False)
 
-    # True = draw is master draw created by admin. User draws are matched to master draw
-    master_draw = db.Column(db.BOOLEAN, nullable=False)
+    # Number of draw numbers matching the winning numbers (set when the draw is played)
+    match_count = db.Column(db.Integer, nullable=False, default=0)
 
-    # Lottery round that draw is used
-    lottery_round = db.Column(db.Integer, nullable=False, default=0)
+    # Lottery round that draw is used (None until played)
+    lottery_round = db.Column(db.Integer, db.ForeignKey(Round.id), nullable=True)
 
-    def __init__(self, user_id, numbers, master_draw, lottery_round):
+    __table_args__ = (
+        # a user's draws by played state (view_draws, check_draws, play_again)
+        db.Index('ix_draws_user_played', user_id, been_played),
+        # all of a user's draws in id order (export_draws)
+        db.Index('ix_draws_user', user_id, id),
+        # unplayed draws (run_lottery)
+        db.Index('ix_draws_played', been_played),
+        # played draws by round (archive_draws)
+        db.Index('ix_draws_round', lottery_round),
+    )
+
+    def __init__(self, user_id, numbers):
         self.user_id = user_id
         self.numbers = numbers
         self.been_played = False
         self.matches_master = False
-        self.master_draw = master_draw
+        self.match_count = 0
+        self.lottery_round = None
+
+    # view draw with the owner's draw keys
+    def view_draw(self, draw_key, private_key):
+        self.numbers = decrypt(self.numbers, draw_key, private_key, self.user_id)
+
+
+# encrypt data with a user's data key (unwrapped with their private key, once per process)
+def encrypt(data, draw_key, private_key, user_id=None):
+    return seal(key_cache.data_key(user_id, draw_key, private_key), data.encode('utf-8'))
+
+
+# encrypt many values with one data key
+def encrypt_many(data, draw_key, private_key, user_id=None):
+    cipher = key_cache.data_key(user_id, draw_key, private_key)
+    return [seal(cipher, value.encode('utf-8')) for value in data]
+
+
+# decrypt data with a user's data key, or with their private key if it was encrypted before data keys
+def decrypt(data, draw_key, private_key, user_id=None):
+    rsa_key = key_cache.private_key(user_id, private_key)
+    if is_rsa_ciphertext(data, rsa_key):
+        return rsa.decrypt(data, rsa_key).decode('utf-8')
+    return unseal(key_cache.data_key(user_id, draw_key, private_key), data).decode('utf-8')
+
+
+class RoundResult(db.Model):
+    __tablename__ = 'round_results'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Lottery round and prize tier (number of matching numbers)
+    lottery_round = db.Column(db.Integer, db.ForeignKey(Round.id), nullable=False)
+    tier = db.Column(db.Integer, nullable=False)
+
+    # Winners in this tier, computed once at settlement as [user id, email, numbers]
+    winner_count = db.Column(db.Integer, nullable=False, default=0)
+    winners = db.Column(db.JSON, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint(lottery_round, tier),
+    )
+
+    def __init__(self, lottery_round, tier, winners):
         self.lottery_round = lottery_round
+        self.tier = tier
+        self.winner_count = len(winners)
+        self.winners = winners
+
+    # precomputed winners of a round grouped by tier, as (round, numbers, user id, email)
+    @staticmethod
+    def winners_by_tier(lottery_round):
+        results = RoundResult.query.filter_by(lottery_round=lottery_round).order_by(RoundResult.tier.desc()).all()
+        return {result.tier: [(lottery_round, numbers, user_id, email) for numbers, user_id, email in result.winners]
+                for result in results}
+
 
-    # view draw with symmetric key
-    # def view_draw(self, draw_key):
-    #     self.numbers = decrypt(self.numbers, draw_key)
+class ArchivedDraw(db.Model):
+    __tablename__ = 'draws_archive'
 
-    # view draw with asymmetric key
-    def view_draw(self, private_key):
-        private_key = pickle.loads(private_key)
-        self.numbers = rsa.decrypt(self.numbers, private_key).decode('utf-8')
+    # ID of the draw while it was live
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    lottery_round = db.Column(db.Integer, db.ForeignKey(Round.id), nullable=False)
 
+    # Played numbers in their compact bitmask encoding (see lottery.numbers)
+    numbers_mask = db.Column(db.BigInteger, nullable=False)
+    match_count = db.Column(db.SmallInteger, nullable=False)
 
-# encrypt date with symmetric key
-# def encrypt(data, key):
-#     return Fernet(key).encrypt(data.encode('utf-8'))
+    __table_args__ = (
+        db.Index('ix_draws_archive_user_round', user_id, lottery_round),
+    )
 
 
-# decrypt data with symmetric key
-# def decrypt(data, key):
-#     return Fernet(key).decrypt(data).decode('utf-8')
+class SecurityEvent(db.Model):
+    __tablename__ = 'security_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Event type (see security_log.SECURITY_EVENTS), who it concerns and where it came from
+    event = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    email = db.Column(db.String(100), nullable=True)
+    ip = db.Column(db.String(45), nullable=True)
+    created_on = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        # covers the per IP/user/hour aggregates of one event type over a time range
+        db.Index('ix_security_events_event_time', event, created_on, ip, user_id),
+        # events from one IP address or for one user over a time range
+        db.Index('ix_security_events_ip', ip, event, created_on),
+        db.Index('ix_security_events_user', user_id, event, created_on),
+    )
+
+
+class ActivitySummary(db.Model):
+    __tablename__ = 'activity_summary'
+
+    # Start of the hour the counts cover
+    hour = db.Column(db.DateTime, primary_key=True)
+
+    # Users registered, logins, and users logging in for the first time that day, within the hour
+    registrations = db.Column(db.Integer, nullable=False, default=0)
+    logins = db.Column(db.Integer, nullable=False, default=0)
+    active_users = db.Column(db.Integer, nullable=False, default=0)
+
+
+# add to the activity counts of the hour containing when (committed with the caller's session)
+def record_activity(when, registrations=0, logins=0, active_users=0):
+    hour = when.replace(minute=0, second=0, microsecond=0)
+    counts = {'registrations': registrations, 'logins': logins, 'active_users': active_users}
+    statement = upsert_insert(db.engine.dialect, ActivitySummary)
+
+    if statement is not None:
+        statement = statement.values(hour=hour, **counts)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[ActivitySummary.hour],
+            set_={'registrations': ActivitySummary.registrations + statement.excluded.registrations,
+                  'logins': ActivitySummary.logins + statement.excluded.logins,
+                  'active_users': ActivitySummary.active_users + statement.excluded.active_users}))
+        return
+
+    # other databases: add to the hour's counts, or start them if it has none yet
+    updated = db.session.execute(update(ActivitySummary).where(ActivitySummary.hour == hour).values(
+        registrations=ActivitySummary.registrations + registrations,
+        logins=ActivitySummary.logins + logins,
+        active_users=ActivitySummary.active_users + active_users)).rowcount
+    if not updated:
+        db.session.execute(insert(ActivitySummary).values(hour=hour, **counts))
+
+
+# dashboard totals from the hourly activity counts
+def activity_totals(now):
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    day_ago = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)
+    registered, active, logins = db.session.query(
+        func.sum(ActivitySummary.registrations),
+        func.sum(case((ActivitySummary.hour >= today, ActivitySummary.active_users), else_=0)),
+        func.sum(case((ActivitySummary.hour >= day_ago, ActivitySummary.logins), else_=0))).one()
+    return {'registered_users': registered or 0, 'active_today': active or 0, 'logins_24h': logins or 0}
+
+
+# rebuild the activity counts from the users table (for databases created before the summary existed)
+def rebuild_activity_summary():
+    db.session.execute(delete(ActivitySummary))
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    for registered_on, current_login in db.session.query(User.registered_on, User.current_login) \
+            .filter_by(role='user').yield_per(1000):
+        record_activity(registered_on, registrations=1)
+        # only the latest login of each user is known
+        if current_login is not None:
+            record_activity(current_login, logins=1, active_users=int(current_login >= today))
+    db.session.commit()
+
+
+# QUERIES ON DRAWS
+# (shared by the views, settlement and hot_draw_queries(), so the plans checked are those of the queries issued)
+
+# a user's draws that have or have not been played (view_draws, check_draws)
+def user_draws(user_id, played):
+    return Draw.query.filter_by(been_played=played, user_id=user_id)
+
+
+# all of a user's draws (export_draws)
+def exported_draws(user_id):
+    return db.session.query(Draw.id, Draw.numbers, Draw.been_played, Draw.lottery_round, Draw.match_count,
+                            Draw.matches_master).filter_by(user_id=user_id)
+
+
+# draws not yet played (run_lottery)
+def unplayed_draws():
+    return db.session.query(Draw.id, Draw.user_id, Draw.numbers).filter_by(been_played=False)
+
+
+# played draws of settled rounds matching criteria (archive_draws)
+def archivable_draws(*criteria):
+    return db.session.query(Draw.id, Draw.user_id, Draw.lottery_round, Draw.numbers, Draw.match_count) \
+        .filter_by(been_played=True).filter(*criteria) \
+        .join(Round, Round.id == Draw.lottery_round).filter_by(settled=True)
+
+
+# up to limit draws of a query after the given draw id (keyset pagination on primary key)
+def draws_after(query, after, limit):
+    return query.filter(Draw.id > after).order_by(Draw.id).limit(limit)
+
+
+# move played draws matching criteria out of the live draws table, one chunk per transaction
+# (only draws of settled rounds, the winners of a round being settled are read back from its draws at the end)
+def archive_draws(*criteria, chunk_size=1000):
+    archived = 0
+
+    while True:
+        draws = draws_after(archivable_draws(*criteria), 0, chunk_size).all()
+
+        if not draws:
+            return archived
+
+        masks = masks_from_strings([draw.numbers for draw in draws]).tolist()
+        db.session.execute(insert(ArchivedDraw), [{'id': draw.id,
+                                                   'user_id': draw.user_id,
+                                                   'lottery_round': draw.lottery_round,
+                                                   'numbers_mask': mask,
+                                                   'match_count': draw.match_count}
+                                                  for draw, mask in zip(draws, masks)])
+        db.session.execute(delete(Draw).where(Draw.id.in_([draw.id for draw in draws])))
+        db.session.commit()
 
-# encrypt data with asymmetric key
-def encrypt(data, public_key):
-    public_key = pickle.loads(public_key)
-    return rsa.encrypt(data.encode('utf-8'), public_key)
+        archived += len(draws)
 
 
-# decrypt data with asymmetric key
-def decrypt(data, private_key):
-    private_key = pickle.loads(private_key)
-    return rsa.decrypt(data, private_key).decode('utf-8')
+class MigrationCheckpoint(db.Model):
+    __tablename__ = 'migration_checkpoints'
+
+    # Name of the migration (e.g. 'reencrypt_draws')
+    name = db.Column(db.String(100), primary_key=True)
+
+    # Pass of the migration in progress (e.g. 'draws', then 'keys')
+    phase = db.Column(db.String(20), nullable=False, default='draws')
+
+    # Highest row ID done in this pass, committed along with each batch of the migration
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+
+    # Rows read and rows rewritten so far
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    rewritten = db.Column(db.Integer, nullable=False, default=0)
+
+    started_on = db.Column(db.DateTime, nullable=False)
+    updated_on = db.Column(db.DateTime, nullable=False)
+
+
+# give users registered before data keys a data key, adding the column to databases created before them
+def add_data_keys(chunk_size=1000):
+    added = 0
+
+    if 'draw_key' not in {column['name'] for column in inspect(db.engine).get_columns('users')}:
+        db.session.execute(db.text('ALTER TABLE users ADD COLUMN draw_key BLOB'))
+        db.session.commit()
+
+    while True:
+        users = db.session.query(User.id, User.public_draw_key).filter(User.draw_key.is_(None)) \
+            .order_by(User.id).limit(chunk_size).all()
+        if not users:
+            return added
+        db.session.execute(update(User), [{'id': user.id,
+                                           'draw_key': wrap_data_key(generate_data_key(),
+                                                                     key_cache.public_key(user.id,
+                                                                                          user.public_draw_key))}
+                                          for user in users])
+        db.session.commit()
+        added += len(users)
+
+
+# re-encrypt a value in the current ciphertext format (decrypting it in whichever format it's in),
+# None if it's already current
+def reencrypt(ciphertext, draw_key, private_key, user_id=None):
+    if ciphertext_version(ciphertext, key_cache.private_key(user_id, private_key)) == CIPHERTEXT_VERSION:
+        return None
+    return encrypt(decrypt(ciphertext, draw_key, private_key, user_id), draw_key, private_key, user_id)
+
+
+# queries on draws issued on every request or settlement, checked by check_query_plans()
+def hot_draw_queries():
+    return {
+        'view_draws': draws_after(user_draws(1, played=False), 0, app.config['DRAWS_MAX_PAGE_SIZE']),
+        'check_draws': draws_after(user_draws(1, played=True), 0, app.config['DRAWS_MAX_PAGE_SIZE']),
+        'export_draws': draws_after(exported_draws(1), 0, app.config['DRAWS_MAX_PAGE_SIZE']),
+        'play_again': draws_after(archivable_draws(Draw.user_id == 1), 0, 1000),
+        'run_lottery': draws_after(unplayed_draws(), 0, app.config['SETTLEMENT_CHUNK_SIZE']),
+        'archive_rounds': draws_after(archivable_draws(Draw.lottery_round <= 1), 0, 1000),
+    }
+
+
+# EXPLAIN each hot query and fail if any of them falls back to a table scan or sorts its rows (SQLite only)
+def check_query_plans():
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            return
+
+        scans = []
+        for name, query in hot_draw_queries().items():
+            sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+            plan = db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql)).all()
+            scans += ['%s: %s' % (name, row.detail) for row in plan
+                      if row.detail.startswith('SCAN draws') or row.detail.startswith('USE TEMP B-TREE')]
+
+        if scans:
+            raise RuntimeError('Queries on draws fall back to a table scan or sort:\n' + '\n'.join(scans))
 
 
 def init_db():
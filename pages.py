@@ -0,0 +1,56 @@
+# IMPORTS
+import hashlib
+from datetime import datetime, timezone
+
+from flask import render_template, request, session, make_response
+from flask_login import current_user
+from markupsafe import Markup
+
+from app import app
+from cache import LRUCache
+
+# rendered pages and template fragments shared by all requests, keyed on template and the context they depend on
+template_cache = LRUCache(app.config['TEMPLATE_CACHE_SIZE'])
+
+
+# who a page is rendered for, as far as the navbar is concerned
+def viewer():
+    return current_user.role if current_user.is_authenticated else 'anonymous'
+
+
+# cache the body of {% call fragment('name') %} ... {% endcall %} for each kind of viewer
+@app.template_global()
+def fragment(name, caller):
+    if app.debug:  # templates are reloaded while debugging
+        return caller()
+    return template_cache.get_or_load(('fragment', name, viewer()), lambda: Markup(caller()))
+
+
+def render(template, context):
+    body = render_template(template, **context)
+    etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+    return body, etag, datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def render_page(template, status=200, **context):
+    """Render a page that only depends on its template, context and the viewer, from the cache where possible
+
+    Successful responses carry an ETag and Last-Modified so clients can revalidate with a 304.
+    """
+    # flashed messages are shown once, so pages carrying them are never cached
+    if app.debug or session.get('_flashes'):
+        return render_template(template, **context), status
+
+    key = ('page', template, viewer(), tuple(sorted(context.items())))
+    body, etag, last_modified = template_cache.get_or_load(key, lambda: render(template, context))
+
+    response = make_response(body, status)
+    response.vary.add('Cookie')
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    if status == 200:
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True  # always revalidate, the page changes when the viewer logs in or out
+        response.make_conditional(request)
+    return response
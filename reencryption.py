@@ -0,0 +1,219 @@
+# IMPORTS
+import time
+from datetime import datetime
+
+import click
+import rsa
+from sqlalchemy import update, bindparam, func
+
+from app import app, db
+from keys import dump_key, wrap_data_key, unwrap_data_key
+from models import User, Draw, Round, MigrationCheckpoint, add_data_keys, reencrypt, key_cache, keypair_pool
+
+CHECKPOINT = 'reencrypt_draws'
+
+
+class Throttle:
+    """Paces batches so each takes at least count / rate seconds (0 = unthrottled)
+
+    Each batch is paced against the end of the one before, so time lost to a stall (e.g. waiting for a lock) is
+    never made up with a burst.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.last = time.monotonic()
+
+    def wait(self, count):
+        if self.rate > 0:
+            delay = self.last + count / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self.last = time.monotonic()
+
+
+# draw keys of the owners of a batch of draws that have not already been loaded (single IN query)
+def load_keys(draws, keys):
+    missing_ids = {draw.user_id for draw in draws} - keys.keys()
+
+    if missing_ids:
+        for owner in db.session.query(User.id, User.draw_key, User.private_draw_key) \
+                .filter(User.id.in_(missing_ids)).all():
+            keys[owner.id] = owner
+
+    return keys
+
+
+# rewrite columns of a batch of rows only where column still holds the value that was read, so a row changed
+# meanwhile by a request or settlement (e.g. a draw that was played) is left alone
+# rows are dicts of row_id, old (the value read) and new_<name> for each of the updated columns
+def compare_and_swap(table, column, rows, *updated):
+    if not rows:
+        return 0
+    statement = update(table).where(table.c.id == bindparam('row_id'), table.c[column] == bindparam('old')) \
+        .values({name: bindparam('new_' + name) for name in updated})
+    return db.session.execute(statement, rows).rowcount
+
+
+# rewrite unplayed draws in the current ciphertext format, returns (rows read, rows rewritten)
+def reencrypt_draw_batch(last_id, batch_size, keys):
+    draws = db.session.query(Draw.id, Draw.user_id, Draw.numbers) \
+        .filter_by(been_played=False) \
+        .filter(Draw.id > last_id) \
+        .order_by(Draw.id).limit(batch_size).all()
+
+    load_keys(draws, keys)
+
+    rows = []
+    for draw in draws:
+        owner = keys[draw.user_id]
+        numbers = reencrypt(draw.numbers, owner.draw_key, owner.private_draw_key, draw.user_id)
+        if numbers is not None:
+            rows.append({'row_id': draw.id, 'old': draw.numbers, 'new_numbers': numbers})
+
+    return draws, compare_and_swap(Draw.__table__, 'numbers', rows, 'numbers')
+
+
+# rewrite winning numbers of the current round (settled rounds are stored decrypted)
+def reencrypt_rounds(keys):
+    rewritten = 0
+    for current_round in db.session.query(Round.id, Round.user_id, Round.numbers).filter_by(settled=False):
+        load_keys([current_round], keys)
+        owner = keys[current_round.user_id]
+        numbers = reencrypt(current_round.numbers, owner.draw_key, owner.private_draw_key, current_round.user_id)
+        if numbers is not None:
+            rewritten += compare_and_swap(Round.__table__, 'numbers', [{'row_id': current_round.id,
+                                                                        'old': current_round.numbers,
+                                                                        'new_numbers': numbers}], 'numbers')
+    return rewritten
+
+
+# store users' RSA keys as DER and give those whose keys aren't key_bits long new keys, re-wrapping their data key
+# (draws are encrypted with the data key, so they are unchanged), returns (rows read, rows rewritten)
+def rewrite_key_batch(last_id, batch_size, key_bits):
+    users = db.session.query(User.id, User.draw_key, User.public_draw_key, User.private_draw_key) \
+        .filter(User.id > last_id) \
+        .order_by(User.id).limit(batch_size).all()
+
+    rows = []
+    for user in users:
+        public_key = key_cache.public_key(user.id, user.public_draw_key)
+        private_key = key_cache.private_key(user.id, user.private_draw_key)
+        draw_key = user.draw_key
+
+        if private_key.n.bit_length() != key_bits:
+            data_key = unwrap_data_key(draw_key, private_key)
+            public_key, private_key = keypair_pool.take() if key_bits == keypair_pool.bits else rsa.newkeys(key_bits)
+            draw_key = wrap_data_key(data_key, public_key)
+        elif dump_key(public_key) == user.public_draw_key and dump_key(private_key) == user.private_draw_key:
+            continue
+
+        rows.append({'row_id': user.id, 'old': user.private_draw_key, 'new_draw_key': draw_key,
+                     'new_public_draw_key': dump_key(public_key), 'new_private_draw_key': dump_key(private_key)})
+
+    return users, compare_and_swap(User.__table__, 'private_draw_key', rows,
+                                   'draw_key', 'public_draw_key', 'private_draw_key')
+
+
+def reencrypt_draws(batch_size, rows_per_second, key_bits, restart=False, progress=None):
+    """Rewrite draws, winning numbers and draw keys stored in an older format
+
+    The migration runs in two passes over rows in ID order: unplayed draws are rewritten in the current ciphertext
+    format (then the current round's winning numbers), then users' draw keys are rewritten as DER and replaced if they
+    aren't key_bits long. Draws go first, as those encrypted before data keys need the user's old RSA key.
+
+    Each batch is written back with one bulk UPDATE, committed together with the migration's checkpoint, so a stopped
+    migration resumes after the last committed batch. The checkpoint is removed once both passes are done.
+    progress(checkpoint, rows done in this pass, rows in this pass) is called after each batch.
+    """
+    MigrationCheckpoint.__table__.create(db.engine, checkfirst=True)
+    add_data_keys(batch_size)
+
+    checkpoint = db.session.get(MigrationCheckpoint, CHECKPOINT)
+    if checkpoint is not None and restart:
+        db.session.delete(checkpoint)
+        db.session.commit()
+        checkpoint = None
+    if checkpoint is None:
+        now = datetime.now()
+        checkpoint = MigrationCheckpoint(name=CHECKPOINT, phase='draws', last_id=0, processed=0, rewritten=0,
+                                         started_on=now, updated_on=now)
+        db.session.add(checkpoint)
+        db.session.commit()
+
+    keys = {}
+    throttle = Throttle(rows_per_second)
+
+    for phase in ('draws', 'keys'):
+        if phase == 'keys' and checkpoint.phase == 'draws':
+            # draws are done, move on to the keys from the first user
+            checkpoint.rewritten += reencrypt_rounds(keys)
+            checkpoint.phase = 'keys'
+            checkpoint.last_id = 0
+            checkpoint.updated_on = datetime.now()
+            db.session.commit()
+        elif phase != checkpoint.phase:
+            continue
+
+        # rows left in this pass, for progress reporting
+        if phase == 'draws':
+            total = db.session.query(func.count(Draw.id)).filter_by(been_played=False) \
+                .filter(Draw.id > checkpoint.last_id).scalar()
+        else:
+            total = db.session.query(func.count(User.id)).filter(User.id > checkpoint.last_id).scalar()
+        done = 0
+
+        while True:
+            if phase == 'draws':
+                rows, rewritten = reencrypt_draw_batch(checkpoint.last_id, batch_size, keys)
+            else:
+                rows, rewritten = rewrite_key_batch(checkpoint.last_id, batch_size, key_bits)
+
+            if not rows:
+                break
+
+            done += len(rows)
+            checkpoint.rewritten += rewritten
+            checkpoint.processed += len(rows)
+            checkpoint.last_id = rows[-1].id
+            checkpoint.updated_on = datetime.now()
+            db.session.commit()
+
+            if progress is not None:
+                progress(checkpoint, done, max(total, done))
+
+            # leave the database to live traffic between batches
+            throttle.wait(len(rows))
+
+    stats = {'processed': checkpoint.processed,
+             'rewritten': checkpoint.rewritten,
+             'seconds': (datetime.now() - checkpoint.started_on).total_seconds()}
+
+    # done, the next run starts from the beginning
+    db.session.delete(checkpoint)
+    db.session.commit()
+
+    return stats
+
+
+# rewrite draws and draw keys stored in an older format or key size: flask reencrypt-draws
+@app.cli.command('reencrypt-draws')
+@click.option('--batch-size', type=int, default=lambda: app.config['REENCRYPT_BATCH_SIZE'],
+              help='Rows read and written back per transaction.')
+@click.option('--rows-per-second', type=float, default=lambda: app.config['REENCRYPT_ROWS_PER_SECOND'],
+              help='Rate to stay under, 0 for no limit.')
+@click.option('--key-bits', type=int, default=lambda: app.config['DRAW_KEY_BITS'],
+              help='RSA key size that draw keys of another size are replaced with.')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint of a stopped run and start from the first draw.')
+def reencrypt_draws_command(batch_size, rows_per_second, key_bits, restart):
+    def progress(checkpoint, done, total):
+        click.echo('%s: %d/%d rows, %d rewritten in total, up to ID %d' % (checkpoint.phase, done, total,
+                                                                          checkpoint.rewritten, checkpoint.last_id))
+
+    try:
+        stats = reencrypt_draws(batch_size, rows_per_second, key_bits, restart, progress)
+    except KeyboardInterrupt:
+        click.echo('Stopped, run again to resume after the last committed batch.')
+        return
+
+    click.echo('Done: %(processed)d rows read, %(rewritten)d rewritten in %(seconds).1fs' % stats)
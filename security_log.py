@@ -0,0 +1,277 @@
+# IMPORTS
+import atexit
+import gzip
+import logging
+import os
+import queue
+import shutil
+import threading
+from datetime import date
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import fcntl
+except ImportError:  # Windows: run a single app process
+    fcntl = None
+
+# security events are logged to this logger rather than being picked out of the root logger by message text
+security_logger = logging.getLogger('security')
+
+# event types passed as extra={'event': ...} along with the user id, email and IP address
+SECURITY_EVENTS = ('register', 'register_admin', 'login', 'login_failed', 'logout', 'rate_limited', 'forbidden')
+
+
+# path of the sidecar offset index kept next to a log file
+def index_path(filename):
+    return filename + '.idx'
+
+
+# path of a compressed archive of a log file, numbered from 1 (newest)
+def archive_path(filename, number):
+    return '%s.%d.gz' % (filename, number)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that never blocks the request thread, records are dropped and counted when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    # leave formatting to the writer thread (log arguments are plain values that won't change after the call)
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+class IndexedFileHandler(logging.Handler):
+    """Log file handler that also appends (offset, event, user id, IP) of every record to a sidecar index file
+
+    Every app process runs its own writer on the same log, so records are buffered and written out by flush() while
+    holding an exclusive lock on the log's lock file. Offsets are taken from the size of the log at that point.
+    """
+
+    def __init__(self, filename, encoding='utf-8'):
+        super().__init__()
+        self.baseFilename = os.path.abspath(filename)
+        self.index_filename = index_path(self.baseFilename)
+        self.lock_filename = self.baseFilename + '.lock'
+        self.encoding = encoding
+        self.terminator = '\n'
+        self._records = []
+        self._lock_file = None
+        self._log = None
+        self._index = None
+
+    def emit(self, record):
+        try:
+            self._records.append((self.format(record) + self.terminator, record))
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            records, self._records = self._records, []
+            if not records:
+                return
+            try:
+                if self._lock_file is None:
+                    self._lock_file = open(self.lock_filename, 'a')
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+                try:
+                    self.write(records)
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            except Exception:
+                self.handleError(records[-1][1])
+
+    # open the log and its index for appending
+    def open_files(self):
+        self._log = open(self.baseFilename, 'ab')
+        self._index = open(self.index_filename, 'ab')
+
+    def close_files(self):
+        if self._log is not None:
+            # the log is written out before the index that points into it
+            self._log.close()
+            self._index.close()
+            self._log = self._index = None
+
+    # the open log has been rotated away by another process
+    def moved(self):
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self._log.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    # open the log (again, if another process has rotated it away), returns the offset the next record goes to
+    def open_current(self):
+        if self._log is not None and self.moved():
+            self.close_files()
+        if self._log is None:
+            self.open_files()
+        return os.fstat(self._log.fileno()).st_size
+
+    # write a record to the log and its offset to the index, returns the offset of the next record
+    def append(self, offset, line, record):
+        data = line.encode(self.encoding)
+        self._log.write(data)
+        self._index.write(('%d\t%s\t%s\t%s\n' % (offset, getattr(record, 'event', '-'),
+                                                 getattr(record, 'user_id', '-'),
+                                                 getattr(record, 'ip', '-'))).encode('utf-8'))
+        return offset + len(data)
+
+    def flush_files(self):
+        # the log is written out before the index that points into it
+        self._log.flush()
+        self._index.flush()
+
+    # called with the lock held
+    def write(self, records):
+        offset = self.open_current()
+        for line, record in records:
+            offset = self.append(offset, line, record)
+        self.flush_files()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.close_files()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+        super().close()
+
+
+class RotatingIndexedFileHandler(IndexedFileHandler):
+    """Indexed file handler that archives the log with gzip when it reaches max_bytes or a new day starts
+
+    Rotation runs on the writer thread under the log's lock, so only one process rotates at a time and the others
+    carry on with the new log. Request threads keep queueing records meanwhile.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count):
+        super().__init__(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.day = None
+        self.rotations = 0
+
+    def open_files(self):
+        super().open_files()
+        # a log belongs to the day it was last written (or today, if it's new)
+        self.day = date.fromtimestamp(os.fstat(self._log.fileno()).st_mtime)
+
+    # archive the log before writing a record that would take it past max_bytes or into a new day
+    def should_rotate(self, offset, record):
+        return offset >= self.max_bytes or date.fromtimestamp(record.created) != self.day
+
+    # called with the lock held
+    def write(self, records):
+        offset = self.open_current()
+        for line, record in records:
+            if offset and self.should_rotate(offset, record):
+                self.close_files()
+                self.rotate()
+                self.open_files()
+                offset = 0
+            offset = self.append(offset, line, record)
+        self.flush_files()
+
+    def rotate(self):
+        # shift the archives up one, dropping those past the retention count
+        for number in range(self.backup_count, 0, -1):
+            source = archive_path(self.baseFilename, number)
+            for path in (source, index_path(source)):
+                if not os.path.exists(path):
+                    continue
+                if number == self.backup_count:
+                    os.remove(path)
+                else:
+                    os.replace(path, path.replace(source, archive_path(self.baseFilename, number + 1), 1))
+
+        if self.backup_count:
+            with open(self.baseFilename, 'rb') as log, gzip.open(archive_path(self.baseFilename, 1), 'wb') as archive:
+                shutil.copyfileobj(log, archive)
+            os.replace(self.index_filename, index_path(archive_path(self.baseFilename, 1)))
+        else:
+            os.remove(self.index_filename)
+        os.remove(self.baseFilename)
+        self.rotations += 1
+
+
+class BatchingQueueListener(QueueListener):
+    """Queue listener that flushes its handlers once the queue is drained or batch_size records have been written"""
+
+    def __init__(self, log_queue, *handlers, batch_size=100):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.written = 0
+        self.batches = 0
+        self._pending = 0
+
+    def handle(self, record):
+        super().handle(record)
+        self.written += 1
+        self._pending += 1
+        if self._pending >= self.batch_size or self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+            self.batches += 1
+            self._pending = 0
+
+
+class SecurityLog:
+    """Background writer for security events, started once by the app"""
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self.running = False
+
+    def start(self, filename, queue_size, batch_size, max_bytes, backup_count, *handlers):
+        log_queue = queue.Queue(queue_size)
+
+        file_handler = RotatingIndexedFileHandler(filename, max_bytes, backup_count)
+        file_handler.setLevel(logging.WARNING)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p'))
+
+        self.handler = DroppingQueueHandler(log_queue)
+        security_logger.addHandler(self.handler)
+        security_logger.setLevel(logging.WARNING)
+        security_logger.propagate = False
+
+        # further handlers (e.g. the audit table) see the same records on the writer thread
+        self.listener = BatchingQueueListener(log_queue, file_handler, *handlers, batch_size=batch_size)
+        self.listener.start()
+        self.running = True
+        atexit.register(self.stop)  # write out whatever is still queued
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+
+    def stats(self):
+        if self.listener is None:
+            return {}
+        return {'queue_depth': self.handler.queue.qsize(),
+                'queue_size': self.handler.queue.maxsize,
+                'dropped': self.handler.dropped,
+                'written': self.listener.written,
+                'batches': self.listener.batches,
+                'rotations': self.listener.handlers[0].rotations}
+
+
+security_log = SecurityLog()
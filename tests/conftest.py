@@ -0,0 +1,99 @@
+# IMPORTS
+import os
+import sys
+import tempfile
+
+import pytest
+
+# the app reads its configuration when it is imported, so point its databases and log at a scratch directory first
+scratch = tempfile.mkdtemp()
+os.environ.update({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(scratch, 'lottery.db'),
+                   'SQLALCHEMY_ECHO': 'False',
+                   'JOBS_DATABASE': os.path.join(scratch, 'jobs.db'),
+                   'RATELIMIT_SQLITE_PATH': os.path.join(scratch, 'ratelimit.db'),
+                   'SECURITY_LOG_FILE': os.path.join(scratch, 'lottery.log'),
+                   'KEYPAIR_POOL_SIZE': '0',
+                   # tests log in many times from the same address, rate limiting has its own tests
+                   'LOGIN_ATTEMPTS_PER_IP': '1000',
+                   'BCRYPT_ROUNDS': '4',
+                   'HASH_WORKERS': '1',
+                   'SETTLEMENT_WORKERS': '1'})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyotp  # noqa: E402
+from flask import session  # noqa: E402
+from flask_wtf.csrf import generate_csrf  # noqa: E402
+
+from app import app, db  # noqa: E402
+from models import User, init_db  # noqa: E402
+from pages import template_cache  # noqa: E402
+from users.identity import identity_cache, MemoryBackend  # noqa: E402
+
+# forms are posted without reCAPTCHA responses
+app.config['TESTING'] = True
+
+
+@pytest.fixture
+def database():
+    """A fresh database with only the admin user, used inside an app context"""
+    init_db()
+    with app.app_context():
+        yield db
+
+
+@pytest.fixture
+def create_user(database):
+    """Factory adding a user (with their draw keys) to the test database"""
+    def create(email, role='user'):
+        user = User(email=email, firstname='Test', lastname='User', date_of_birth='01/01/2000', postcode='NE1 7RU',
+                    phone='1234-123-1234', password='Test1!', role=role)
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    return create
+
+
+@pytest.fixture
+def client(database, monkeypatch):
+    """Test client making HTTPS requests (Talisman redirects plain HTTP), with empty page and identity caches"""
+    template_cache.clear()
+    # user ids are reused by every fresh database
+    monkeypatch.setattr(identity_cache, 'backend', MemoryBackend())
+
+    client = app.test_client()
+    open_request = client.open
+
+    def open_https(*args, **kwargs):
+        kwargs.setdefault('base_url', 'https://localhost')
+        # each request gets its own app context (g, session) rather than sharing the test's
+        with app.app_context():
+            return open_request(*args, **kwargs)
+
+    client.open = open_https
+    return client
+
+
+@pytest.fixture
+def csrf_token(client):
+    """Factory for a CSRF token valid for the test client's session, as rendered into its forms"""
+    def token():
+        # a fresh app context, generate_csrf keeps the token it made in g
+        with app.app_context(), app.test_request_context():
+            signed = generate_csrf()
+            raw = session['csrf_token']
+        with client.session_transaction() as client_session:
+            client_session['csrf_token'] = raw
+        return signed
+
+    return token
+
+
+@pytest.fixture
+def login(client, csrf_token):
+    """Log the test client in as a user created by create_user"""
+    def log_in(user, password='Test1!'):
+        return client.post('/login', data={'email': user.email, 'password': password, 'postcode': 'NE1 7RU',
+                                           'pin': pyotp.TOTP(user.pin_key).now(), 'csrf_token': csrf_token()})
+
+    return log_in
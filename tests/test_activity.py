@@ -0,0 +1,57 @@
+# IMPORTS
+from datetime import datetime
+
+from sqlalchemy.dialects import postgresql
+
+import models
+from app import app, db
+from models import ActivitySummary, record_activity, activity_totals, rebuild_activity_summary
+
+WHEN = datetime(2026, 1, 1, 12, 30)
+
+
+def counts():
+    return [(row.hour, row.registrations, row.logins, row.active_users) for row in ActivitySummary.query.all()]
+
+
+def test_record_activity_adds_to_the_hour(database):
+    record_activity(WHEN, registrations=1)
+    record_activity(WHEN.replace(minute=59), logins=1, active_users=1)
+    db.session.commit()
+    assert counts() == [(datetime(2026, 1, 1, 12), 1, 1, 1)]
+
+
+def test_record_activity_without_upsert(database, monkeypatch):
+    monkeypatch.setattr(models, 'upsert_insert', lambda dialect, table: None)
+    record_activity(WHEN, registrations=1)
+    record_activity(WHEN, logins=2)
+    db.session.commit()
+    assert counts() == [(datetime(2026, 1, 1, 12), 1, 2, 0)]
+
+
+def test_record_activity_compiles_for_postgresql(database, monkeypatch):
+    dialect = postgresql.dialect()
+    statements = []
+    monkeypatch.setattr(db.engine, 'dialect', dialect)
+    monkeypatch.setattr(db.session, 'execute', statements.append)
+    record_activity(WHEN, logins=1)
+    assert 'ON CONFLICT (hour) DO UPDATE' in str(statements[0].compile(dialect=dialect))
+
+
+def test_dashboard_totals_survive_a_rebuild(client, create_user, login):
+    for email, role in (('user@email.com', 'user'), ('other@email.com', 'user'), ('admin2@email.com', 'admin')):
+        login(create_user(email, role=role))
+        client.get('/logout')
+
+    # (the users were added directly, so only a rebuild counts their registrations)
+    totals = activity_totals(datetime.now())
+    assert (totals['active_today'], totals['logins_24h']) == (2, 2)
+    rebuild_activity_summary()
+    assert activity_totals(datetime.now()) == dict(totals, registered_users=2)
+
+
+def test_rebuild_command(client, create_user, login):
+    login(create_user('user@email.com'))
+    result = app.test_cli_runner().invoke(args=['rebuild-activity-summary'])
+    assert result.exit_code == 0
+    assert 'active today: 1, logins in the last 24 hours: 1' in result.output
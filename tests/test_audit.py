@@ -0,0 +1,23 @@
+# IMPORTS
+from datetime import datetime
+
+from sqlalchemy.dialects import postgresql
+
+from app import db
+from audit import events_per_hour
+from database import hour_bucket
+from models import SecurityEvent
+
+
+def test_events_per_hour(database):
+    db.session.add_all([SecurityEvent(event='login', created_on=datetime(2026, 1, 1, 12, minute))
+                        for minute in (0, 30, 59)] +
+                       [SecurityEvent(event='login', created_on=datetime(2026, 1, 1, 13, 5)),
+                        SecurityEvent(event='logout', created_on=datetime(2026, 1, 1, 12, 5))])
+    db.session.commit()
+    assert events_per_hour('login', datetime(2026, 1, 1)) == [('2026-01-01 12:00', 3), ('2026-01-01 13:00', 1)]
+
+
+def test_hour_bucket_on_postgresql():
+    sql = str(hour_bucket(postgresql.dialect(), SecurityEvent.created_on).compile(dialect=postgresql.dialect()))
+    assert sql.startswith('date_trunc(')
@@ -0,0 +1,47 @@
+# IMPORTS
+import io
+
+import pytest
+
+from models import Draw
+
+
+@pytest.fixture
+def user(create_user, login):
+    user = create_user('bulk@email.com')
+    login(user)
+    return user
+
+
+def test_json_draws(client, user):
+    response = client.post('/create_draws_bulk', json=[[6, 5, 4, 3, 2, 1], [1, 2, 3], [1, 2, 3, 4, 5, 7.5],
+                                                       ['1', '2', '3', '4', '5', ' 8']])
+    assert response.status_code == 200
+    assert response.json == {'accepted': 1, 'rejected': 3,
+                             'errors': [{'line': 2, 'error': 'Draw must contain exactly 6 numbers'},
+                                        {'line': 3, 'error': 'Draw numbers must be whole numbers'},
+                                        {'line': 4, 'error': 'Draw numbers must be whole numbers'}]}
+    assert Draw.query.filter_by(user_id=user.id).count() == 1
+
+
+def test_csv_draws_with_spaces(client, user):
+    response = client.post('/create_draws_bulk', data='1, 2, 3, 4, 5, 10\n7,8,9 ,10,11,12\n1, 2, x, 4, 5, 6\n',
+                           content_type='text/csv')
+    assert response.status_code == 200
+    assert response.json == {'accepted': 2, 'rejected': 1,
+                             'errors': [{'line': 3, 'error': 'Draw numbers must be whole numbers'}]}
+    assert Draw.query.filter_by(user_id=user.id).count() == 2
+
+
+@pytest.mark.parametrize('with_token, status, accepted', [(True, 200, 1), (False, 400, 0)])
+def test_csv_upload_needs_csrf_token(client, user, csrf_token, with_token, status, accepted):
+    data = {'file': (io.BytesIO(b'1, 2, 3, 4, 5, 6\n'), 'draws.csv')}
+    if with_token:
+        data['csrf_token'] = csrf_token()
+    response = client.post('/create_draws_bulk', data=data, content_type='multipart/form-data')
+    assert response.status_code == status
+    assert Draw.query.filter_by(user_id=user.id).count() == accepted
+
+
+def test_other_content_types_are_refused(client, user):
+    assert client.post('/create_draws_bulk', data='1 2 3 4 5 6', content_type='text/plain').status_code == 415
@@ -0,0 +1,67 @@
+# IMPORTS
+import threading
+import time
+
+import bcrypt
+import pytest
+
+import users.hashing
+from models import password_hasher
+from users.hashing import HashingPool, HashingQueueFull
+
+
+# wait for the pool to have count checks in flight
+def wait_for_in_flight(pool, count):
+    deadline = time.monotonic() + 5
+    while pool.stats()['in_flight'] != count:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def blocked_pool(monkeypatch):
+    """The app's hashing pool with no queue and its only worker stuck in a password check"""
+    monkeypatch.setattr(password_hasher, 'queue_size', 0)
+    release = threading.Event()
+    checkpw = bcrypt.checkpw
+    monkeypatch.setattr(users.hashing.bcrypt, 'checkpw',
+                        lambda password, hashed: release.wait() and checkpw(password, hashed))
+
+    hashed = bcrypt.hashpw(b'Test1!', bcrypt.gensalt(4))
+    blocker = threading.Thread(target=password_hasher.check_password, args=('Test1!', hashed))
+    blocker.start()
+    wait_for_in_flight(password_hasher, password_hasher.workers)
+    yield password_hasher
+
+    release.set()
+    blocker.join()
+
+
+def test_saturated_pool_refuses_work():
+    pool = HashingPool(1, 0, 4)
+    release = threading.Event()
+    blocker = threading.Thread(target=pool._run, args=(release.wait,))
+    blocker.start()
+    wait_for_in_flight(pool, 1)
+
+    with pytest.raises(HashingQueueFull):
+        pool.hash_password('Test1!')
+    assert pool.stats()['rejected'] == 1
+
+    release.set()
+    blocker.join()
+    assert pool.check_password('Test1!', pool.hash_password('Test1!'))
+
+
+@pytest.fixture
+def user(create_user):
+    return create_user('shed@email.com')
+
+
+def test_login_is_shed_with_503(user, client, login, blocked_pool):
+    rejected = blocked_pool.rejected
+
+    response = login(user)
+    assert response.status_code == 503
+    assert b'503 Service Unavailable' in response.data
+    assert blocked_pool.rejected == rejected + 1
@@ -0,0 +1,90 @@
+# IMPORTS
+import pytest
+from sqlalchemy import event
+
+from app import db
+from models import User
+from users.identity import identity_cache, CachedUser
+
+
+@pytest.fixture
+def statements(database):
+    """SQL statements run while the test is running"""
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    yield executed
+    event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def cached(user_id):
+    return identity_cache.backend.get('identity:%d' % user_id)
+
+
+def test_identity_is_loaded_without_credentials_or_keys(client, create_user, statements):
+    user_id = create_user('identity@email.com').id
+    statements.clear()
+
+    identity = identity_cache.load(user_id)
+    assert isinstance(identity, CachedUser)
+    assert (identity.id, identity.email, identity.firstname, identity.role) == \
+        (user_id, 'identity@email.com', 'Test', 'user')
+    assert len(statements) == 1
+    assert 'password' not in statements[0] and 'draw_key' not in statements[0]
+
+    # from the cache from then on
+    identity_cache.load(user_id)
+    assert len(statements) == 1
+
+
+def test_other_attributes_load_the_full_row(client, create_user):
+    user = create_user('identity@email.com')
+    identity = identity_cache.load(user.id)
+
+    assert '_user' not in identity.__dict__
+    assert identity.postcode == 'NE1 7RU'
+    assert identity.verify_password('Test1!')
+    assert identity.is_authenticated
+    with pytest.raises(AttributeError):
+        identity.__deepcopy__
+
+
+def test_logout_drops_the_identity(client, create_user, login):
+    user = create_user('identity@email.com')
+    login(user)
+    assert client.get('/account').status_code == 200
+    assert cached(user.id) is not None
+
+    client.get('/logout')
+    assert cached(user.id) is None
+
+
+def test_change_password_drops_the_identity(client, create_user, login, csrf_token):
+    user = create_user('identity@email.com')
+    login(user)
+    client.get('/account')
+
+    # change_password verifies and changes the password through the cached identity
+    response = client.post('/change_password', data={'current_password': 'Test1!', 'new_password': 'Changed1!',
+                                                     'confirm_new_password': 'Changed1!',
+                                                     'csrf_token': csrf_token()})
+    assert response.status_code == 302
+    assert cached(user.id) is None
+
+    client.get('/logout')
+    assert login(user, password='Changed1!').status_code == 302
+
+
+@pytest.mark.parametrize('column, value', [('role', 'admin'), ('email', 'changed@email.com'),
+                                           ('firstname', 'Changed')])
+def test_changes_to_the_identity_drop_it(client, create_user, column, value):
+    user = create_user('identity@email.com')
+    identity_cache.load(user.id)
+
+    setattr(db.session.get(User, user.id), column, value)
+    db.session.commit()
+    assert cached(user.id) is None
+    assert getattr(identity_cache.load(user.id), column) == value
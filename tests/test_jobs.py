@@ -0,0 +1,57 @@
+# IMPORTS
+import random
+
+import pytest
+
+from admin.settlement import settle_round_job
+from app import app, db
+from jobs import JobQueue, LeaseLost, job_handler
+from models import Draw, Round
+from test_settlement import create_round, expected_winners, stored_winners
+
+
+@job_handler('test_job')
+def report_once(job, report):
+    report(1, 1, None)
+    return 'done by handler'
+
+
+def test_expired_job_belongs_to_the_worker_that_took_it_over(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'jobs.db'), lease=0)
+    job_id, _ = jobs.enqueue('test_job', 'test', {})
+
+    assert jobs.claim('first')['id'] == job_id
+    assert jobs.claim('second')['id'] == job_id  # the first worker's lease has expired
+
+    with pytest.raises(LeaseLost):
+        jobs.report(job_id, 'first', 1, 1, None)
+    with pytest.raises(LeaseLost):
+        jobs.finish(job_id, 'first', 'result')
+
+    jobs.finish(job_id, 'second', 'result')
+    assert jobs.get(job_id)['status'] == 'done'
+    with pytest.raises(LeaseLost):
+        jobs.fail(job_id, 'first', 'too late')
+    assert jobs.get(job_id)['result'] == 'result'
+
+
+def test_settlement_taken_over_by_another_worker(create_user, monkeypatch):
+    monkeypatch.setitem(app.config, 'SETTLEMENT_CHUNK_SIZE', 50)
+    round_id, draws, winning_numbers = create_round(create_user, random.Random(5))
+    job = {'id': 1, 'payload': {'round': round_id}}
+
+    # the first worker stalls after its first chunk while a second worker settles the whole round
+    def stalled(processed, total, checkpoint):
+        with app.app_context():
+            settle_round_job(job, lambda *args: None)
+
+    with pytest.raises(LeaseLost):
+        with app.app_context():
+            settle_round_job(job, stalled)
+
+    db.session.expire_all()
+    current_round = db.session.get(Round, round_id)
+    assert current_round.settled
+    assert current_round.entries == len(draws)
+    assert Draw.query.filter_by(lottery_round=round_id).count() == len(draws)
+    assert stored_winners(round_id) == expected_winners(draws, winning_numbers)
@@ -0,0 +1,32 @@
+# IMPORTS
+import pytest
+
+from lottery.numbers import validate_draws
+
+WHOLE_NUMBERS = 'Draw numbers must be whole numbers'
+
+
+def test_ints_and_digit_strings_are_accepted():
+    indexes, numbers, errors = validate_draws([[6, 5, 4, 3, 2, 1], ['1', '2', '3', '4', '5', '60']])
+    assert indexes == [0, 1]
+    assert numbers.tolist() == [[1, 2, 3, 4, 5, 6], [1, 2, 3, 4, 5, 60]]
+    assert errors == {}
+
+
+@pytest.mark.parametrize('number', [7.9, 7.0, True, '7.0', ' 7', '+7', '-7', '٧', None, [7]])
+def test_other_values_are_rejected(number):
+    indexes, numbers, errors = validate_draws([[1, 2, 3, 4, 5, number]])
+    assert indexes == []
+    assert errors == {0: WHOLE_NUMBERS}
+
+
+@pytest.mark.parametrize('number', [0, 61, -1, 10 ** 30, '9' * 30])
+def test_out_of_range(number):
+    indexes, numbers, errors = validate_draws([[1, 2, 3, 4, 5, number]])
+    assert errors == {0: 'Draw numbers must be between 1 and 60'}
+
+
+def test_errors_are_kept_by_line():
+    indexes, numbers, errors = validate_draws([[1, 2, 3, 4, 5, 6.5], [1, 2, 3, 4, 5, 6], [1, 1, 3, 4, 5, 6]])
+    assert indexes == [1]
+    assert errors == {0: WHOLE_NUMBERS, 2: 'You cannot have duplicate numbers'}
@@ -0,0 +1,49 @@
+# IMPORTS
+from pages import template_cache
+
+
+def test_etag_round_trip(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    assert response.headers['ETag'] and response.headers['Last-Modified']
+    assert 'no-cache' in response.headers['Cache-Control']
+
+    revalidated = client.get('/', headers={'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b''
+
+    assert client.get('/', headers={'If-None-Match': '"stale"'}).status_code == 200
+
+
+def test_pages_with_pending_flashes_are_not_cached(client):
+    with client.session_transaction() as session:
+        session['_flashes'] = [('message', 'Shown once')]
+
+    response = client.get('/')
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+    assert template_cache.get(('page', 'main/index.html', 'anonymous', ())) is None
+
+    # the flash is still waiting to be shown, so the page is still rendered afresh
+    assert 'ETag' not in client.get('/').headers
+
+
+def test_navbar_is_cached_per_kind_of_viewer(client, create_user, login):
+    anonymous = client.get('/')
+    assert b'href="/login"' in anonymous.data and b'href="/logout"' not in anonymous.data
+
+    login(create_user('pages@email.com'))
+    user = client.get('/')
+    assert b'href="/logout"' in user.data and b'href="/lottery"' in user.data and b'href="/login"' not in user.data
+    assert user.headers['ETag'] != anonymous.headers['ETag']
+    assert 'private' in user.headers['Cache-Control']
+    # an anonymous page's ETag doesn't revalidate the logged in page
+    assert client.get('/', headers={'If-None-Match': anonymous.headers['ETag']}).status_code == 200
+
+    client.get('/logout')
+    login(create_user('admin2@email.com', role='admin'))
+    admin = client.get('/')
+    assert b'href="/admin"' in admin.data and b'href="/lottery"' not in admin.data
+
+    client.get('/logout')
+    assert client.get('/').data == anonymous.data
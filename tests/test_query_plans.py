@@ -0,0 +1,19 @@
+# IMPORTS
+import pytest
+
+from app import db
+from models import check_query_plans
+
+
+def test_hot_queries_use_indexes(database):
+    check_query_plans()
+
+
+def test_export_without_its_index_is_rejected(database):
+    db.session.execute(db.text('DROP INDEX ix_draws_user'))
+    db.session.commit()
+    # EXPLAIN doesn't reload the schema, so don't let it run on a pooled connection that still has the index
+    db.engine.dispose()
+
+    with pytest.raises(RuntimeError, match='export_draws: USE TEMP B-TREE FOR ORDER BY'):
+        check_query_plans()
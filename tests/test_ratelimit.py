@@ -0,0 +1,105 @@
+# IMPORTS
+import os
+import threading
+
+import pytest
+
+import users.views
+from models import User, password_hasher
+from users.ratelimit import MemoryBackend, SQLiteBackend, RateLimiter
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteBackend(os.path.join(tmp_path, 'ratelimit.db'))
+    return MemoryBackend()
+
+
+# take a token for key from a bucket of 2 refilled over 10 seconds
+def take(backend, key, now):
+    return backend.take(key, 2, 2 / 10, now)
+
+
+def test_bucket_refills_over_the_period(backend):
+    assert take(backend, 'key', 0)[0]
+    assert take(backend, 'key', 0)[0]
+    assert not take(backend, 'key', 0)[0]
+    # one token back after half the period, both after all of it (and never more than the capacity)
+    assert take(backend, 'key', 5) == (True, pytest.approx(0))
+    assert not take(backend, 'key', 5)[0]
+    assert take(backend, 'key', 100) == (True, pytest.approx(1))
+
+
+def test_buckets_are_separate(backend):
+    take(backend, 'a', 0)
+    take(backend, 'a', 0)
+    assert not take(backend, 'a', 0)[0]
+    assert take(backend, 'b', 0)[0]
+
+
+def test_reset(backend):
+    take(backend, 'key', 0)
+    take(backend, 'key', 0)
+    backend.reset('key')
+    assert take(backend, 'key', 0) == (True, pytest.approx(1))
+
+
+def test_memory_backend_sweeps_expired_buckets():
+    backend = MemoryBackend(sweep_interval=60)
+    take(backend, 'old', 0)
+    take(backend, 'new', 58)
+    # 'old' has refilled by the next sweep, 'new' hasn't
+    take(backend, 'other', 60)
+    assert set(backend._buckets) == {'new', 'other'}
+
+
+def test_sqlite_backend_sweeps_expired_buckets(tmp_path):
+    backend = SQLiteBackend(os.path.join(tmp_path, 'ratelimit.db'), sweep_interval=60)
+    take(backend, 'old', 0)
+    take(backend, 'new', 58)
+    take(backend, 'other', 60)
+    keys = {key for key, in backend._connection().execute('SELECT key FROM rate_limits')}
+    assert keys == {'new', 'other'}
+
+
+def test_sqlite_backend_is_shared(tmp_path):
+    # two backends on one file stand in for two app processes, each thread has its own connection too
+    path = os.path.join(tmp_path, 'ratelimit.db')
+    first, second = SQLiteBackend(path), SQLiteBackend(path)
+    results = []
+    threads = [threading.Thread(target=lambda backend=backend: results.append(take(backend, 'key', 0)[0]))
+               for backend in (first, second, first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [False, False, True, True]
+    second.reset('key')
+    assert take(first, 'key', 0)[0]
+
+
+def test_rate_limiter_reports_whole_tokens():
+    limiter = RateLimiter(MemoryBackend(), 3, 300)
+    assert limiter.take('key') == (True, 2)
+    assert limiter.take('key') == (True, 1)
+    assert limiter.take('key') == (True, 0)
+    assert limiter.take('key')[0] is False
+
+
+def test_login_is_limited_before_password_and_pin_checks(create_user, client, login, monkeypatch):
+    monkeypatch.setattr(users.views, 'login_email_limiter', RateLimiter(MemoryBackend(), 1, 300))
+    user = create_user('limited@email.com')
+
+    assert login(user, password='Wrong1!').status_code == 200
+    checked = password_hasher.completed
+
+    def verify_pin(self, pin):
+        raise AssertionError('PIN checked for a rate limited login')
+
+    monkeypatch.setattr(User, 'verify_pin', verify_pin)
+    response = login(user)
+    assert response.status_code == 429
+    assert b'Too many attempts' in response.data
+    assert password_hasher.completed == checked
@@ -0,0 +1,98 @@
+# IMPORTS
+import pickle
+
+import pytest
+import rsa
+from sqlalchemy import insert
+
+import reencryption
+from app import db
+from keys import load_public_key, load_private_key
+from models import User, Draw, Round, MigrationCheckpoint, decrypt, encrypt
+from reencryption import Throttle, reencrypt_draws
+
+
+class Interrupted(Exception):
+    pass
+
+
+# a user as stored before data keys: pickled RSA keys and draws encrypted with RSA alone
+def create_legacy_user(create_user, email, draws):
+    user = create_user(email)
+    public_key, private_key = load_public_key(user.public_draw_key), load_private_key(user.private_draw_key)
+    user.public_draw_key, user.private_draw_key, user.draw_key = pickle.dumps(public_key), pickle.dumps(private_key), None
+    db.session.execute(insert(Draw), [{'user_id': user.id, 'numbers': rsa.encrypt(numbers.encode(), public_key),
+                                       'been_played': False, 'matches_master': False, 'match_count': 0}
+                                      for numbers in draws])
+    db.session.commit()
+    return user.id
+
+
+def draws_by_user():
+    users = {user.id: user for user in User.query.all()}
+    return sorted((draw.user_id, decrypt(draw.numbers, users[draw.user_id].draw_key,
+                                         users[draw.user_id].private_draw_key, draw.user_id))
+                  for draw in Draw.query.all())
+
+
+def test_reencrypt_draws_and_keys_resumes(create_user):
+    plaintexts = ['%d 2 3 4 5 6' % number for number in range(7, 37)]
+    create_legacy_user(create_user, 'old@email.com', plaintexts)
+    create_legacy_user(create_user, 'older@email.com', plaintexts[:5])
+    admin = User.query.filter_by(role='admin').one()
+    db.session.add(Round(admin.id, encrypt('1 2 3 4 5 6', admin.draw_key, admin.private_draw_key, admin.id)))
+    db.session.commit()
+
+    expected = sorted([(2, numbers) for numbers in plaintexts] + [(3, numbers) for numbers in plaintexts[:5]])
+
+    def stop(checkpoint, done, total):
+        raise Interrupted()
+
+    # stop after the first batch of each pass, then let the migration finish
+    with pytest.raises(Interrupted):
+        reencrypt_draws(10, 0, 576, progress=stop)
+    assert db.session.get(MigrationCheckpoint, 'reencrypt_draws').last_id == 10
+    db.session.rollback()
+
+    def stop_in_keys(checkpoint, done, total):
+        if checkpoint.phase == 'keys':
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        reencrypt_draws(2, 0, 576, progress=stop_in_keys)
+    db.session.rollback()
+    assert db.session.get(MigrationCheckpoint, 'reencrypt_draws').phase == 'keys'
+
+    stats = reencrypt_draws(2, 0, 576)
+
+    db.session.expire_all()
+    assert stats['rewritten'] == len(expected) + 3
+    assert MigrationCheckpoint.query.count() == 0
+    assert draws_by_user() == expected
+    assert all(len(draw.numbers) < 64 for draw in Draw.query.all())
+    for user in User.query.all():
+        assert load_private_key(user.private_draw_key).n.bit_length() == 576
+        assert user.private_draw_key == load_private_key(user.private_draw_key).save_pkcs1('DER')
+        assert user.public_draw_key == load_public_key(user.public_draw_key).save_pkcs1('DER')
+    current_round = Round.query.one()
+    assert decrypt(current_round.numbers, admin.draw_key, admin.private_draw_key, admin.id) == '1 2 3 4 5 6'
+
+    # a second run has nothing left to rewrite
+    assert reencrypt_draws(2, 0, 576)['rewritten'] == 0
+
+
+def test_throttle_does_not_burst_after_a_stall(monkeypatch):
+    clock = [0.0]
+    sleeps = []
+    monkeypatch.setattr(reencryption.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(reencryption.time, 'sleep', lambda seconds: (sleeps.append(seconds),
+                                                                     clock.__setitem__(0, clock[0] + seconds)))
+
+    throttle = Throttle(100)
+    clock[0] += 0.05
+    throttle.wait(10)  # a 10 row batch that took 0.05s waits out the rest of 0.1s
+    clock[0] += 5  # stalled on a lock
+    throttle.wait(10)
+    clock[0] += 0.01
+    throttle.wait(10)  # still paced after the stall
+    assert sleeps == pytest.approx([0.05, 0.09])
@@ -0,0 +1,43 @@
+# IMPORTS
+import logging
+import time
+
+from admin.logs import log_files, tail
+from security_log import IndexedFileHandler, RotatingIndexedFileHandler
+
+
+def record(event, message):
+    return logging.makeLogRecord({'msg': '%s %s' % (event, message), 'levelno': logging.WARNING, 'event': event,
+                                  'user_id': 1, 'ip': '127.0.0.1', 'created': time.time()})
+
+
+# handlers of two app processes taking turns writing batches to the same log
+def take_turns(handlers, batches):
+    for batch in range(batches):
+        handler = handlers[batch % len(handlers)]
+        for i in range(3):
+            handler.handle(record(('login', 'logout')[(batch + i) % 2], 'from %d batch %d' % (batch % 2, batch)))
+        handler.flush()
+
+
+def test_index_offsets_with_two_writers(tmp_path):
+    filename = str(tmp_path / 'lottery.log')
+    handlers = [IndexedFileHandler(filename), IndexedFileHandler(filename)]
+    take_turns(handlers, 6)
+
+    entries, _ = tail(filename, 100, event='login')
+    assert len(entries) == 9
+    assert all(entry.startswith('login ') for entry in entries)
+
+
+def test_rotation_with_two_writers(tmp_path):
+    filename = str(tmp_path / 'lottery.log')
+    handlers = [RotatingIndexedFileHandler(filename, 200, 100), RotatingIndexedFileHandler(filename, 200, 100)]
+    take_turns(handlers, 40)
+
+    assert len(log_files(filename)) > 2
+    for event in ('login', 'logout'):
+        entries, _ = tail(filename, 1000, event=event)
+        assert len(entries) == 60
+        assert all(entry.startswith(event + ' ') for entry in entries)
+    assert len(tail(filename, 1000)[0]) == 120
@@ -0,0 +1,113 @@
+# IMPORTS
+import random
+
+import pytest
+from sqlalchemy import insert
+
+from admin.settlement import settle_round_job
+from app import app, db
+from lottery.numbers import PRIZE_TIERS, masks_from_strings, match_counts, numbers_to_mask
+from models import User, Draw, Round, RoundResult, encrypt, encrypt_many, archive_draws
+
+
+class Interrupted(Exception):
+    pass
+
+
+# a round with random draws from a few users (plus some sure winners), returns (round id, draws, winning numbers)
+def create_round(create_user, rng, entries=400):
+    admin = User.query.filter_by(role='admin').one()
+    winning_numbers = ' '.join(map(str, sorted(rng.sample(range(1, 61), 6))))
+    current_round = Round(admin.id, encrypt(winning_numbers, admin.draw_key, admin.private_draw_key, admin.id))
+    db.session.add(current_round)
+
+    users = [create_user('user%d@email.com' % i) for i in range(3)]
+    draws = []
+    for i in range(entries):
+        user = users[i % len(users)]
+        numbers = winning_numbers if i % 97 == 0 else ' '.join(map(str, sorted(rng.sample(range(1, 61), 6))))
+        draws.append((user.id, numbers))
+
+    for user in users:
+        numbers = [numbers for user_id, numbers in draws if user_id == user.id]
+        db.session.execute(insert(Draw), [{'user_id': user.id, 'numbers': encrypted, 'been_played': False,
+                                           'matches_master': False, 'match_count': 0}
+                                          for encrypted in encrypt_many(numbers, user.draw_key,
+                                                                        user.private_draw_key, user.id)])
+    db.session.commit()
+    return current_round.id, draws, winning_numbers
+
+
+# winners per prize tier computed directly from the plaintext draws
+def expected_winners(draws, winning_numbers):
+    counts = match_counts(masks_from_strings([numbers for _, numbers in draws]),
+                          numbers_to_mask(winning_numbers.split())).tolist()
+    return {tier: counts.count(tier) for tier in PRIZE_TIERS}
+
+
+def stored_winners(round_id):
+    return {result.tier: result.winner_count for result in RoundResult.query.filter_by(lottery_round=round_id)}
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_settlement_resumes_after_interruptions(create_user, seed, monkeypatch):
+    monkeypatch.setitem(app.config, 'SETTLEMENT_CHUNK_SIZE', 50)
+    rng = random.Random(seed)
+    round_id, draws, winning_numbers = create_round(create_user, rng)
+    job = {'id': 1, 'payload': {'round': round_id}}
+
+    # stop the settlement after a random number of committed chunks until it gets to the end
+    interruptions = 0
+    while True:
+        stop_after = rng.randint(1, 3)
+        reported = []
+
+        def report(processed, total, checkpoint):
+            reported.append(processed)
+            if len(reported) == stop_after:
+                raise Interrupted()
+
+        try:
+            with app.app_context():
+                settle_round_job(job, report)
+            break
+        except Interrupted:
+            interruptions += 1
+
+    db.session.expire_all()
+    current_round = db.session.get(Round, round_id)
+    assert interruptions > 0
+    assert current_round.settled
+    assert current_round.numbers == winning_numbers
+    assert current_round.entries == len(draws)
+    assert stored_winners(round_id) == expected_winners(draws, winning_numbers)
+    assert Draw.query.filter_by(been_played=False).count() == 0
+
+
+def test_play_again_during_settlement_keeps_winners(create_user, monkeypatch):
+    monkeypatch.setitem(app.config, 'SETTLEMENT_CHUNK_SIZE', 50)
+    round_id, draws, winning_numbers = create_round(create_user, random.Random(4))
+
+    # every user clears their played draws while the round is being settled
+    def report(processed, total, checkpoint):
+        archive_draws()
+
+    with app.app_context():
+        settle_round_job({'id': 1, 'payload': {'round': round_id}}, report)
+
+    db.session.expire_all()
+    assert db.session.get(Round, round_id).entries == len(draws)
+    assert stored_winners(round_id) == expected_winners(draws, winning_numbers)
+
+
+def test_settlement_with_worker_processes(create_user, monkeypatch):
+    monkeypatch.setitem(app.config, 'SETTLEMENT_WORKERS', 2)
+    monkeypatch.setitem(app.config, 'SETTLEMENT_DECRYPT_CHUNK_SIZE', 50)
+    round_id, draws, winning_numbers = create_round(create_user, random.Random(5))
+
+    with app.app_context():
+        settle_round_job({'id': 1, 'payload': {'round': round_id}}, lambda processed, total, checkpoint: None)
+
+    db.session.expire_all()
+    assert db.session.get(Round, round_id).entries == len(draws)
+    assert stored_winners(round_id) == expected_winners(draws, winning_numbers)
@@ -0,0 +1,107 @@
+# IMPORTS
+import pickle
+from datetime import datetime
+
+import bcrypt
+import pyotp
+import rsa
+from sqlalchemy import inspect
+
+from app import db
+from models import User, Draw, Round, RoundResult, ActivitySummary
+from upgrade import upgrade_db
+
+# the tables of the first version of the app
+FIRST_VERSION_SCHEMA = (
+    'CREATE TABLE users (id INTEGER NOT NULL, email VARCHAR(100) NOT NULL, password BLOB NOT NULL, '
+    'pin_key VARCHAR(32), firstname VARCHAR(100) NOT NULL, lastname VARCHAR(100) NOT NULL, '
+    'date_of_birth VARCHAR(100) NOT NULL, postcode VARCHAR(100) NOT NULL, phone VARCHAR(100) NOT NULL, '
+    'role VARCHAR(100) NOT NULL, registered_on DATETIME NOT NULL, current_login DATETIME, last_login DATETIME, '
+    'current_login_ip VARCHAR(100), last_login_ip VARCHAR(100), total_logins INTEGER NOT NULL, '
+    'public_draw_key BLOB NOT NULL, private_draw_key BLOB NOT NULL, PRIMARY KEY (id), UNIQUE (email))',
+    'CREATE TABLE draws (id INTEGER NOT NULL, user_id INTEGER NOT NULL, numbers VARCHAR(100) NOT NULL, '
+    'been_played BOOLEAN NOT NULL, matches_master BOOLEAN NOT NULL, master_draw BOOLEAN NOT NULL, '
+    'lottery_round INTEGER NOT NULL, PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES users (id))',
+)
+
+
+def create_first_version(database):
+    database.drop_all()
+    for statement in FIRST_VERSION_SCHEMA:
+        database.session.execute(db.text(statement))
+
+    keys = {}
+    for user_id, email, role in ((1, 'admin@email.com', 'admin'), (2, 'old@email.com', 'user')):
+        public_key, private_key = rsa.newkeys(512)
+        keys[user_id] = public_key
+        database.session.execute(db.text(
+            "INSERT INTO users VALUES (:id, :email, :password, :pin_key, 'Old', 'User', '01/01/2000', 'NE1 7RU', "
+            "'1234-123-1234', :role, :now, NULL, NULL, NULL, NULL, 0, :public_key, :private_key)"),
+            {'id': user_id, 'email': email, 'password': bcrypt.hashpw(b'Test1!', bcrypt.gensalt(4)),
+             'pin_key': pyotp.random_base32(), 'role': role,
+             'now': datetime.now(), 'public_key': pickle.dumps(public_key), 'private_key': pickle.dumps(private_key)})
+
+    # round 1 played (numbers stored decrypted), round 2 waiting for its draws
+    draws = [(1, 1, '1 2 3 4 5 6', True, False, True, 1),
+             (2, 2, '6 5 4 3 2 1', True, True, False, 1),
+             (3, 2, '1 2 3 4 5 60', True, False, False, 1),
+             (4, 2, '10 20 30 40 50 60', True, False, False, 1),
+             (5, 1, rsa.encrypt(b'7 8 9 10 11 12', keys[1]), False, False, True, 2),
+             (6, 2, rsa.encrypt(b'7 8 9 10 11 13', keys[2]), False, False, False, 0)]
+    for draw in draws:
+        database.session.execute(db.text('INSERT INTO draws VALUES (:id, :user_id, :numbers, :been_played, '
+                                         ':matches_master, :master_draw, :lottery_round)'),
+                                 dict(zip(('id', 'user_id', 'numbers', 'been_played', 'matches_master',
+                                           'master_draw', 'lottery_round'), draw)))
+    database.session.commit()
+
+
+def test_first_version_is_upgraded(database):
+    create_first_version(database)
+    upgrade_db()
+    database.session.expire_all()
+
+    assert [(r.id, r.settled, r.entries, r.winners) for r in Round.query.order_by(Round.id)] == \
+        [(1, True, 3, 2), (2, False, 0, 0)]
+    assert db.session.get(Round, 1).numbers == '1 2 3 4 5 6'
+    assert {result.tier: result.winners for result in RoundResult.query.filter_by(lottery_round=1)} == \
+        {6: [['6 5 4 3 2 1', 2, 'old@email.com']], 5: [['1 2 3 4 5 60', 2, 'old@email.com']], 4: [], 3: []}
+    assert [(d.id, d.been_played, d.match_count, d.lottery_round) for d in Draw.query.order_by(Draw.id)] == \
+        [(2, True, 6, 1), (3, True, 5, 1), (4, True, 0, 1), (6, False, 0, None)]
+
+    # the waiting round and the user's draw still decrypt with the old keys
+    admin, user = db.session.get(User, 1), db.session.get(User, 2)
+    assert admin.draw_key is None
+    current_round = db.session.get(Round, 2)
+    current_round.view_numbers(admin.draw_key, admin.private_draw_key)
+    assert current_round.numbers == '7 8 9 10 11 12'
+    draw = db.session.get(Draw, 6)
+    draw.view_draw(user.draw_key, user.private_draw_key)
+    assert draw.numbers == '7 8 9 10 11 13'
+    db.session.rollback()
+
+    # nothing left to do the second time
+    upgrade_db()
+    assert Draw.query.count() == 4 and RoundResult.query.count() == 4
+
+
+def test_logging_in_after_the_upgrade(database, client, login):
+    create_first_version(database)
+    upgrade_db()
+
+    assert login(db.session.get(User, 2)).status_code == 302
+    assert ActivitySummary.query.one().logins == 1
+
+
+def test_missing_tables_columns_and_indexes_are_added(database):
+    database.session.execute(db.text('DROP TABLE activity_summary'))
+    database.session.execute(db.text('DROP INDEX ix_draws_user'))
+    database.session.execute(db.text('ALTER TABLE rounds DROP COLUMN settled_through'))
+    database.session.commit()
+
+    upgrade_db()
+
+    inspector = inspect(db.engine)
+    assert inspector.has_table('activity_summary')
+    assert 'ix_draws_user' in {index['name'] for index in inspector.get_indexes('draws')}
+    assert 'settled_through' in {column['name'] for column in inspector.get_columns('rounds')}
@@ -0,0 +1,145 @@
+# IMPORTS
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import inspect, insert, update, select, bindparam, literal, text
+from sqlalchemy.schema import CreateColumn
+
+from app import app, db
+from lottery.numbers import PRIZE_TIERS, numbers_to_mask, masks_from_strings, match_counts
+from models import User, Draw, Round, RoundResult
+
+
+# a transaction that DDL is part of, holding SQLite's write lock throughout so app processes starting together
+# upgrade one at a time (the others then find nothing left to do)
+@contextmanager
+def upgrade_transaction(engine):
+    if engine.dialect.name != 'sqlite':
+        with engine.begin() as connection:
+            yield connection
+        return
+
+    with engine.connect() as connection:
+        # pysqlite only begins transactions before DML by itself, so begin explicitly
+        connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.exec_driver_sql('ROLLBACK')
+            raise
+        connection.exec_driver_sql('COMMIT')
+
+
+# DEFAULT clause for adding a NOT NULL column to a table that already has rows, None if the column has no fixed default
+def column_default(column, dialect):
+    if column.server_default is not None or column.nullable:
+        return ''
+    if column.default is None or not column.default.is_scalar:
+        return None
+    return ' DEFAULT ' + str(literal(column.default.arg).compile(dialect=dialect,
+                                                                 compile_kwargs={'literal_binds': True}))
+
+
+# add the columns and indexes of the models that tables created by earlier versions are missing
+def add_missing_columns(connection):
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            default = column_default(column, connection.dialect)
+            if default is None:
+                logging.warning('Cannot add %s.%s (NOT NULL without a default) to the existing table, recreate the '
+                                'database with init_db', table.name, column.name)
+                continue
+            connection.exec_driver_sql('ALTER TABLE %s ADD COLUMN %s%s' % (
+                table.name, CreateColumn(column).compile(dialect=connection.dialect), default))
+
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+
+
+# the first version kept each round's winning numbers as a 'master' draw of the admin who set them, with user draws
+# pointing at its round number: move those into rounds and rebuild draws without the master_draw column
+def upgrade_master_draws(connection):
+    for index in inspect(connection).get_indexes('draws'):
+        connection.exec_driver_sql('DROP INDEX %s' % index['name'])
+    connection.exec_driver_sql('ALTER TABLE draws RENAME TO draws_master')
+    Draw.__table__.create(connection)
+
+    # one round per round number (the latest master draw, if an admin replaced it), settled if it has been played
+    masters = {}
+    for master in connection.execute(text('SELECT id, user_id, numbers, been_played, lottery_round '
+                                          'FROM draws_master WHERE master_draw ORDER BY id')):
+        masters[master.lottery_round] = master
+    now = datetime.now()
+    if masters:
+        connection.execute(insert(Round), [{'id': master.lottery_round,
+                                            'user_id': master.user_id,
+                                            'numbers': master.numbers,
+                                            'settled': bool(master.been_played),
+                                            'created_on': now,
+                                            'settled_on': now if master.been_played else None,
+                                            'entries': 0,
+                                            'winners': 0,
+                                            'settled_through': 0}
+                                           for master in masters.values()])
+
+    # unplayed draws had round 0, not yet a round
+    connection.execute(text('INSERT INTO draws (id, user_id, numbers, been_played, matches_master, match_count, '
+                            'lottery_round) '
+                            'SELECT id, user_id, numbers, been_played, matches_master, 0, '
+                            'CASE WHEN been_played THEN lottery_round END '
+                            'FROM draws_master WHERE NOT master_draw'))
+    connection.exec_driver_sql('DROP TABLE draws_master')
+
+    # played draws and the numbers of settled rounds are stored decrypted, so their results can be worked out here
+    for master in masters.values():
+        if master.been_played:
+            store_results(connection, master.lottery_round, master.numbers)
+
+
+# match counts, per-tier winners and statistics of a round settled by the first version
+def store_results(connection, lottery_round, winning_numbers):
+    draws = connection.execute(select(Draw.id, Draw.user_id, Draw.numbers, User.email)
+                               .join(User, User.id == Draw.user_id)
+                               .where(Draw.lottery_round == lottery_round).order_by(Draw.id)).all()
+    counts = match_counts(masks_from_strings([draw.numbers for draw in draws]),
+                          numbers_to_mask(winning_numbers.split())).tolist()
+
+    if draws:
+        connection.execute(update(Draw).where(Draw.id == bindparam('draw_id')).values(match_count=bindparam('count')),
+                           [{'draw_id': draw.id, 'count': count} for draw, count in zip(draws, counts)])
+
+    winners = {tier: [[draw.numbers, draw.user_id, draw.email] for draw, count in zip(draws, counts) if count == tier]
+               for tier in PRIZE_TIERS}
+    connection.execute(insert(RoundResult), [{'lottery_round': lottery_round, 'tier': tier,
+                                              'winner_count': len(results), 'winners': results}
+                                             for tier, results in winners.items()])
+    connection.execute(update(Round).where(Round.id == lottery_round).values(
+        entries=len(draws), winners=sum(len(results) for results in winners.values())))
+
+
+def upgrade_db():
+    """Bring a database created by an earlier version up to the current models, keeping its users and draws
+
+    Run when the app starts, every step is skipped once it has been applied. Users registered before data keys get
+    theirs from 'flask reencrypt-draws'.
+    """
+    with app.app_context(), upgrade_transaction(db.engine) as connection:
+        inspector = inspect(connection)
+        first_version = inspector.has_table('draws') and \
+            'master_draw' in {column['name'] for column in inspector.get_columns('draws')}
+
+        # new tables (with their indexes)
+        db.metadata.create_all(connection)
+
+        if first_version:
+            upgrade_master_draws(connection)
+
+        add_missing_columns(connection)
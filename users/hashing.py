@@ -0,0 +1,56 @@
+# IMPORTS
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class HashingQueueFull(ServiceUnavailable):
+    """Raised when bcrypt work is refused because the hashing pool is saturated (handled as a 503)"""
+
+    description = 'Too many password checks in progress. Please try again shortly.'
+
+
+class HashingPool:
+    """Bounded pool of threads for bcrypt hashing and verification (bcrypt releases the GIL)"""
+
+    def __init__(self, workers, queue_size, rounds):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rounds = rounds
+        self.completed = 0
+        self.rejected = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+
+    def _run(self, fn, *args):
+        # refuse work straight away rather than queueing without bound
+        with self._lock:
+            if self._in_flight >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise HashingQueueFull()
+            self._in_flight += 1
+
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self.completed += 1
+
+    def hash_password(self, password):
+        return self._run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+
+    def check_password(self, password, hashed):
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), hashed)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers,
+                    'queue_size': self.queue_size,
+                    'in_flight': self._in_flight,
+                    'queue_depth': max(0, self._in_flight - self.workers),
+                    'completed': self.completed,
+                    'rejected': self.rejected}
@@ -0,0 +1,96 @@
+# IMPORTS
+import time
+
+from flask_login import UserMixin
+from sqlalchemy import event
+from werkzeug.utils import import_string
+
+from app import db, app
+from cache import LRUCache
+from models import User
+
+# columns kept in the identity cache (everything needed to authorise a request)
+IDENTITY_COLUMNS = (User.id, User.email, User.firstname, User.role)
+
+
+class MemoryBackend:
+    """In-process cache backend with per-entry expiry (same get/set/delete interface as cachelib caches)"""
+
+    def __init__(self, maxsize=10000):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, key):
+        entry = self._cache.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value, timeout):
+        self._cache.put(key, (time.monotonic() + timeout, value))
+
+    def delete(self, key):
+        self._cache.pop(key)
+
+
+class CachedUser(UserMixin):
+    """Slim identity of the logged in user, loading the full User row only when another attribute is needed"""
+
+    def __init__(self, id, email, firstname, role):
+        self.id = id
+        self.email = email
+        self.firstname = firstname
+        self.role = role
+
+    # called only for attributes not in the identity (password, draw keys, login history, methods...)
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if '_user' not in self.__dict__:
+            self.__dict__['_user'] = db.session.get(User, self.id)
+        return getattr(self.__dict__['_user'], name)
+
+
+class IdentityCache:
+    """Cache of user identities for the login manager's user_loader"""
+
+    def __init__(self, backend, timeout):
+        self.backend = backend
+        self.timeout = timeout
+
+    @staticmethod
+    def create(backend, timeout, maxsize):
+        # a shared backend is given as an import path to a factory, e.g. 'cachelib.redis:RedisCache'
+        if backend:
+            return IdentityCache(import_string(backend)(), timeout)
+        return IdentityCache(MemoryBackend(maxsize), timeout)
+
+    def load(self, user_id):
+        key = 'identity:%d' % user_id
+        identity = self.backend.get(key)
+
+        if identity is None:
+            row = db.session.query(*IDENTITY_COLUMNS).filter(User.id == user_id).first()
+            if row is None:
+                return None
+            identity = {'id': row.id, 'email': row.email, 'firstname': row.firstname, 'role': row.role}
+            self.backend.set(key, identity, self.timeout)
+
+        return CachedUser(**identity)
+
+    def invalidate(self, user_id):
+        self.backend.delete('identity:%d' % user_id)
+
+
+# identities of logged in users, shared by all requests
+identity_cache = IdentityCache.create(app.config['USER_CACHE_BACKEND'], app.config['USER_CACHE_TTL'],
+                                      app.config['USER_CACHE_SIZE'])
+
+
+# cached identities must not outlive a change to the user's credentials or role
+@event.listens_for(User.email, 'set')
+@event.listens_for(User.firstname, 'set')
+@event.listens_for(User.role, 'set')
+@event.listens_for(User.password, 'set')
+def invalidate_identity(target, value, oldvalue, initiator):
+    if target.id is not None:
+        identity_cache.invalidate(target.id)
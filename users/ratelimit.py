@@ -0,0 +1,109 @@
+# IMPORTS
+import os
+import sqlite3
+import threading
+import time
+
+
+class MemoryBackend:
+    """In-process token buckets, expired (fully refilled) buckets are swept periodically"""
+
+    def __init__(self, sweep_interval=60):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._sweep_interval = sweep_interval
+        self._next_sweep = 0
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+            tokens, updated, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            # bucket can be forgotten once it would have refilled completely
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            return allowed, tokens
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def _sweep(self, now):
+        for key in [key for key, bucket in self._buckets.items() if bucket[2] <= now]:
+            del self._buckets[key]
+        self._next_sweep = now + self._sweep_interval
+
+
+class SQLiteBackend:
+    """Token buckets in a SQLite database, shared by all worker processes on the host"""
+
+    def __init__(self, path, sweep_interval=60):
+        self.path = path
+        self._local = threading.local()
+        self._sweep_interval = sweep_interval
+        self._next_sweep = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS rate_limits '
+                           '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, expires REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_rate_limits_expires ON rate_limits (expires)')
+
+    # one connection per thread, sqlite3 connections can't be shared between threads
+    def _connection(self):
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        return self._local.connection
+
+    def take(self, key, capacity, rate, now):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if now >= self._next_sweep:
+                connection.execute('DELETE FROM rate_limits WHERE expires <= ?', (now,))
+                self._next_sweep = now + self._sweep_interval
+
+            row = connection.execute('SELECT tokens, updated FROM rate_limits WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            connection.execute('INSERT OR REPLACE INTO rate_limits (key, tokens, updated, expires) VALUES (?, ?, ?, ?)',
+                               (key, tokens, now, now + (capacity - tokens) / rate))
+            connection.execute('COMMIT')
+            return allowed, tokens
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def reset(self, key):
+        self._connection().execute('DELETE FROM rate_limits WHERE key = ?', (key,))
+
+
+class RateLimiter:
+    """Token bucket limiter: capacity requests per key, refilled evenly over period seconds"""
+
+    def __init__(self, backend, capacity, period):
+        self.backend = backend
+        self.capacity = capacity
+        self.rate = capacity / period
+
+    # take one token for key, returns (allowed, whole tokens remaining)
+    def take(self, key):
+        allowed, tokens = self.backend.take(key, self.capacity, self.rate, time.time())
+        return allowed, int(tokens)
+
+    def reset(self, key):
+        self.backend.reset(key)
+
+
+def create_backend(name, sqlite_path):
+    if name == 'sqlite':
+        return SQLiteBackend(sqlite_path)
+    return MemoryBackend()
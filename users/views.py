@@ -1,18 +1,37 @@
 # IMPORTS
-import logging
 from datetime import datetime
 
 from flask import Blueprint, render_template, flash, redirect, url_for, session, request
 from flask_login import login_user, current_user, logout_user, login_required
-from markupsafe import Markup
+from sqlalchemy.orm import undefer_group
 
-from app import db, anonymous_required
-from models import User
+from app import db, app, anonymous_required
+from security_log import security_logger
+from models import User, record_activity
+from users.identity import identity_cache
 from users.forms import RegisterForm, LoginForm, ChangePasswordForm
+from users.ratelimit import RateLimiter, create_backend
 
 # CONFIG
 users_blueprint = Blueprint('users', __name__, template_folder='templates')
 
+# login and registration attempts are limited server side (per IP address and per email)
+rate_limit_backend = create_backend(app.config['RATELIMIT_BACKEND'], app.config['RATELIMIT_SQLITE_PATH'])
+login_ip_limiter = RateLimiter(rate_limit_backend, app.config['LOGIN_ATTEMPTS_PER_IP'],
+                               app.config['LOGIN_ATTEMPTS_PERIOD'])
+login_email_limiter = RateLimiter(rate_limit_backend, app.config['LOGIN_ATTEMPTS_PER_EMAIL'],
+                                  app.config['LOGIN_ATTEMPTS_PERIOD'])
+register_ip_limiter = RateLimiter(rate_limit_backend, app.config['REGISTRATIONS_PER_IP'],
+                                  app.config['REGISTRATIONS_PERIOD'])
+
+
+# refuse a rate limited request
+def too_many_attempts(template, form, log_message):
+    security_logger.warning(log_message + ' [%s, %s]', form.email.data, request.remote_addr,
+                            extra={'event': 'rate_limited', 'email': form.email.data, 'ip': request.remote_addr})
+    flash('Too many attempts. Please try again later.', 'danger')
+    return render_template(template, form=form), 429
+
 
 # VIEWS
 # view registration
@@ -25,7 +44,12 @@ def register():
     validation_message = ""
     # if request method is POST or form is valid
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        # limit registrations before any password hashing or key generation
+        allowed, _ = register_ip_limiter.take('register-ip:%s' % request.remote_addr)
+        if not allowed:
+            return too_many_attempts('users/register.html', form, 'SECURITY - Registration rate limit exceeded')
+
+        user = db.session.query(User.id).filter_by(email=form.email.data).first()
         # if this returns a user, then the email already exists in database
 
         # if email already exists redirect user back to signup page with error message so user can try again
@@ -45,10 +69,13 @@ def register():
 
         # add the new user to the database
         db.session.add(new_user)
+        record_activity(new_user.registered_on, registrations=1)
         db.session.commit()
 
         # log registration
-        logging.warning('SECURITY - User registered [%s, %s]', form.email.data, request.remote_addr)
+        security_logger.warning('SECURITY - User registered [%s, %s]', form.email.data, request.remote_addr,
+                                extra={'event': 'register', 'user_id': new_user.id, 'email': form.email.data,
+                                       'ip': request.remote_addr})
 
         # add user to session
         session['username'] = form.email.data
@@ -79,11 +106,11 @@ def setup_2fa():
 
 # handle failed login attempts
 @anonymous_required
-def failed_login(form, request, validation_message):
-    session['authentication_attempts'] += 1
-    logging.warning(f'SECURITY - User login failed. Attempted username: {form.email.data} [{request.remote_addr}]')
+def failed_login(form, request, validation_message, attempts_remaining):
+    security_logger.warning('SECURITY - User login failed. Attempted username: %s [%s]', form.email.data,
+                            request.remote_addr,
+                            extra={'event': 'login_failed', 'email': form.email.data, 'ip': request.remote_addr})
 
-    attempts_remaining = 3 - session['authentication_attempts']
     flash(f'You have {attempts_remaining} attempts remaining', 'info')
 
     return render_template('users/login.html', form=form, validation_message=validation_message)
@@ -96,39 +123,45 @@ def login():
     form = LoginForm()
     validation_message = ""
 
-    # store authentication attempts in flask session
-    if not session.get('authentication_attempts'):
-        session['authentication_attempts'] = 0
-
-    if session['authentication_attempts'] == 2:  # 3 attempts
-        flash(Markup('Too many authentication attempts. Please click <a href="/reset">here</a> to reset'), 'danger')
-        return render_template('users/login.html')
-
     if form.validate_on_submit():
-        username = User.query.filter_by(email=form.email.data).first()
+        # limit attempts per IP address and per email before any bcrypt or TOTP work
+        allowed, _ = login_ip_limiter.take('login-ip:%s' % request.remote_addr)
+        if allowed:
+            allowed, attempts_remaining = login_email_limiter.take('login-email:%s' % form.email.data.lower())
+        if not allowed:
+            return too_many_attempts('users/login.html', form, 'SECURITY - Login rate limit exceeded')
+
+        username = User.query.options(undefer_group('credentials')).filter_by(email=form.email.data).first()
         password = form.password.data
         postcode = form.postcode.data
         pin = form.pin.data
 
         if not username or not User.verify_password(username, password):
-            return failed_login(form, request, 'Username or password is incorrect')
+            return failed_login(form, request, 'Username or password is incorrect', attempts_remaining)
 
         if not username.verify_pin(pin) or not username.verify_postcode(postcode):
-            return failed_login(form, request, 'PIN/Postcode is incorrect')
+            return failed_login(form, request, 'PIN/Postcode is incorrect', attempts_remaining)
 
-        session['authentication_attempts'] = 0  # reset attempts if successful login
+        login_email_limiter.reset('login-email:%s' % form.email.data.lower())  # reset attempts if successful login
         login_user(username)  # Add user to session
 
         # update database log information
+        now = datetime.now()
+        # the dashboard only counts users (as rebuild_activity_summary does), not admins
+        if username.role == 'user':
+            first_today = username.current_login is None or username.current_login.date() != now.date()
+            record_activity(now, logins=1, active_users=int(first_today))
         username.last_login = username.current_login
-        username.current_login = datetime.now()
+        username.current_login = now
         username.total_logins += 1
         username.current_login_ip = request.remote_addr
         username.last_login_ip = username.current_login_ip
         db.session.commit()
 
-        logging.warning('SECURITY - User logged in [%s, %s, %s]', current_user.id, current_user.email,
-                        request.remote_addr)
+        security_logger.warning('SECURITY - User logged in [%s, %s, %s]', current_user.id, current_user.email,
+                                request.remote_addr,
+                                extra={'event': 'login', 'user_id': current_user.id, 'email': current_user.email,
+                                       'ip': request.remote_addr})
 
         if current_user.role == 'admin':
             return redirect(url_for('admin.admin'))
@@ -138,21 +171,16 @@ def login():
     return render_template('users/login.html', form=form, validation_message=validation_message)
 
 
-# reset authentication attempts
-@users_blueprint.route('/reset')
-@anonymous_required
-def reset():
-    session['authentication_attempts'] = 0
-    return redirect(url_for('users.login'))
-
-
 # logout user
 @users_blueprint.route('/logout')
 @login_required
 def logout():
     if current_user.is_authenticated:
-        logging.warning('SECURITY - User logged out [%s, %s, %s]', current_user.id, current_user.email,
-                        request.remote_addr)
+        security_logger.warning('SECURITY - User logged out [%s, %s, %s]', current_user.id, current_user.email,
+                                request.remote_addr,
+                                extra={'event': 'logout', 'user_id': current_user.id, 'email': current_user.email,
+                                       'ip': request.remote_addr})
+        identity_cache.invalidate(current_user.id)
         logout_user()
 
     return render_template('main/index.html')
@@ -188,12 +216,14 @@ def change_password():
             flash('New passwords do not match')
             return render_template('users/change_password.html', form=form, validation_message=validation_message)
 
-        if current_user.verify_password(form.new_password.data):
+        # current password was just verified, so compare with it directly instead of hashing again
+        if form.new_password.data == form.current_password.data:
             flash('New password cannot be the same as the current password')
             return render_template('users/change_password.html', form=form, validation_message=validation_message)
 
         current_user.change_password(form.new_password.data)
         db.session.commit()
+        identity_cache.invalidate(current_user.id)
 
         flash('Password updated successfully', 'success')
 